@@ -0,0 +1,297 @@
+'''
+Benchmark of the Dash callbacks and layout.py figure builders
+on synthetic data.
+
+The records of csvdata/WeightData.csv and the beaches of
+csvdata/Beach2coord.csv are resampled to the requested sizes and
+fed to store.build_store, the resulting store is installed in the
+in-process cache of main so no database is needed.
+Each callback and figure builder is timed for a set of filters,
+one JSON object per line is written to the output file.
+
+Without --database the load path (reading the tables, main.global_store
+and main.caching) and the sql backend (QUERY_BACKEND=sql) are not
+timed. With --database the synthetic data is imported into that
+scratch Postgres database, replacing its tables, then the load path is
+timed and the callbacks are timed again on the sql backend (filters
+with "backend": "sql").
+
+    python benchmark.py --records 10000 100000 --beaches 600 5000
+    python benchmark.py --compare bench_baseline.txt
+    python benchmark.py --records 100000 --database postgresql://localhost/bench
+'''
+import argparse, contextlib, importlib, io, json, logging, os, platform, shutil, statistics, sys, tempfile, time
+import numpy as np
+import pandas as pd
+import plotly.io as pio
+
+record_sizes = [10_000, 100_000, 1_000_000, 10_000_000]
+beach_sizes = [600, 50_000]
+
+####### SYNTHETIC DATA ###############
+
+def read_csvdata(path='csvdata'):
+    weight = pd.read_csv(os.path.join(path, 'WeightData.csv'), header=None,
+                         names=['Id', 'Beach', 'Lat', 'Longit', 'Weight', 'Dates', 'team', 'person'])
+    beaches = pd.read_csv(os.path.join(path, 'Beach2coord.csv'), header=None,
+                          names=['Id', 'Beach', 'Lat', 'Lon', 'Country', 'State'])
+    return weight, beaches
+
+def synthetic_beaches(beaches, size, rng):
+    '''
+    The real beaches, then copies of them moved by up to 0.05 degree
+    until there are size beaches.
+    '''
+    beaches = beaches.drop_duplicates('Beach')
+    extra = max(size - len(beaches), 0)
+    src = beaches.iloc[rng.integers(0, len(beaches), extra)]
+    new = pd.DataFrame({'Beach': [f'{b} #{i}' for i, b in enumerate(src['Beach'])],
+                        'Lat': src['Lat'].values + rng.uniform(-0.05, 0.05, extra),
+                        'Lon': src['Lon'].values + rng.uniform(-0.05, 0.05, extra),
+                        'Country': src['Country'].values,
+                        'State': src['State'].values})
+    out = pd.concat([beaches.drop(columns='Id').iloc[:size], new], ignore_index=True)
+    out.insert(0, 'Id', np.arange(1, len(out) + 1))
+    return out
+
+def synthetic_records(weight, beaches, size, rng):
+    '''
+    size records spread over the beaches with a Zipf-like popularity,
+    weights, teams and persons drawn from the real records and
+    dates drawn uniformly over the real period.
+    '''
+    popularity = 1. / np.arange(1, len(beaches) + 1)
+    beach = rng.choice(len(beaches), size, p=popularity / popularity.sum())
+    sample = weight.iloc[rng.integers(0, len(weight), size)]
+    dates = pd.to_datetime(weight['Dates'], errors='coerce').dropna()
+    start, span = dates.min(), (dates.max() - dates.min()).days
+    team = sample['team'].values
+    return pd.DataFrame({
+        'Id': np.arange(1, size + 1),
+        'Beach': beaches['Beach'].values[beach],
+        'Lat': beaches['Lat'].values[beach],
+        'Longit': beaches['Lon'].values[beach],
+        'Weight': sample['Weight'].values,
+        'Dates': start + pd.to_timedelta(rng.integers(0, span + 1, size), unit='D'),
+        'team': team,
+        'person': sample['person'].values,
+        'Teams': [[t] if isinstance(t, str) else [] for t in team]})
+
+def load_database(df, beaches, path='csvdata'):
+    '''
+    Replace the tables of the DATABASE_URL database by the synthetic
+    records and beaches (and the real team members) with import.py
+    '''
+    from db import init_db
+    importer = importlib.import_module('import')
+    with tempfile.TemporaryDirectory() as tmp:
+        shutil.copy(os.path.join(path, 'Team_members.csv'), tmp)
+        df.drop(columns='Teams').to_csv(os.path.join(tmp, 'WeightData.csv'),
+                                        header=False, index=False, date_format='%Y-%m-%d')
+        beaches.to_csv(os.path.join(tmp, 'Beach2coord.csv'), header=False, index=False)
+        # import.py prints its progress
+        with contextlib.redirect_stdout(io.StringIO()):
+            importer.import_csv(init_db(), tmp)
+
+####### TIMING ###############
+
+def _trigger(prop_id):
+    # callbacks reading ctx.triggered_id need a callback context
+    from dash._callback_context import context_value
+    from dash._utils import AttributeDict
+    context_value.set(AttributeDict(triggered_inputs=[{'prop_id': prop_id, 'value': None}]))
+
+def timed(func, *args, repeat=5):
+    '''
+    Run func repeat times, return the timings (s) and the size
+    of the JSON sent to the browser for the last output.
+    '''
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = func(*args)
+        timings.append(time.perf_counter() - start)
+    return timings, len(pio.json.to_json_plotly(out))
+
+def timed_load(func, repeat=5):
+    '''
+    Timings (s) of repeat runs of func, a store load
+    '''
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def cases(main, store):
+    '''
+    (name, filters, function, arguments) of every benchmarked call
+    '''
+    from layout import Mk_base_map, Mk_map_weight, draw_stat_curve, mk_crossair, mk_general_curves
+    from plotly.subplots import make_subplots
+
+    grouped, df = store['grouped'], store['df']
+    counts = df['Beach'].value_counts()
+    beaches = {'largest': counts.index[0],
+               'median': counts.index[len(counts) // 2],
+               'smallest': counts.index[-1]}
+    team = main.team_list()[0]
+    year = int(df['Dates'].dt.year.max())
+    # mk_crossair only replaces the crosshair
+    base_map = main.generate_base_map(True)
+    stream = {'mapbox.center': {'lon': -3, 'lat': 55}, 'mapbox.zoom': 7,
+              'mapbox._derived': {'coordinates': [[-2, 56], [-4, 56], [-4, 54], [-2, 54]]}}
+
+    for sw_year in [True, False]:
+        for sw_team in [True, False]:
+            for radio in ['W', 'Nb', 'R']:
+                filters = dict(year=year, all_years=sw_year, team=team, all_teams=sw_team, radio=radio)
+                yield 'Mk_main_map', filters, main.Mk_main_map, (year, sw_year, team, sw_team, radio)
+            filters = dict(year=year, all_years=sw_year, team=team, all_teams=sw_team)
+            yield 'update_portal_curve', filters, main.update_portal_curve, (year, sw_year, team, sw_team)
+            portal = main.portal_stats(year, sw_year, team, sw_team)
+            records = main.portal_records(year, sw_year, team, sw_team)
+            yield 'layout.Mk_map_weight', filters, Mk_map_weight, \
+                (portal, '%{marker.size}', 10, 'Weight')
+            yield 'layout.mk_general_curves', filters, mk_general_curves, (records,)
+    for raster in [False, True]:
+        for radio in ['W', 'R']:
+            yield 'Mk_main_map', dict(radio=radio, raster=raster, view='pan'), main.Mk_main_map, \
+                (year, True, team, True, radio, raster, stream, None, None, stream)
+    for size, beach in beaches.items():
+        filters = dict(beach=size)
+        yield 'update_cum_curve', filters, main.update_cum_curve, (beach,)
+        yield 'get_beach_data', filters, main.get_beach_data, (beach,)
+        yield 'layout.draw_stat_curve', filters, \
+            lambda b=main.beach_daily(beach), m=main.beach_monthly(beach), beach=beach: \
+                draw_stat_curve(b, make_subplots(rows=3, cols=1, shared_xaxes=True), beach, m), ()
+        yield 'read_coord', filters, \
+            lambda beach=beach: (_trigger('beach-choice-map.value'),
+                                 main.read_coord(None, beach))[1], ()
+    yield 'read_coord', dict(stream='pan'), \
+        lambda: (_trigger('beach_picker.relayoutData'),
+                 main.read_coord(stream, None))[1], ()
+    yield 'layout.mk_crossair', dict(stream='pan'), \
+        lambda: mk_crossair(stream, base_map), ()
+    yield 'generate_base_map', {}, main.generate_base_map, (True,)
+    yield 'layout.Mk_base_map', {}, Mk_base_map, (grouped,)
+    yield 'populate_countries', {}, main.populate_countries, (True,)
+    for text in [None, 'b', 'beach', 'baech']:
+        yield 'search_beach', dict(search=text), main.search_beach, (text, None, None, None)
+    yield 'initialise_dropdown', {}, main.initialise_dropdown, (True,)
+
+def run(records, beaches, repeat=5, seed=0, path='csvdata', database=None):
+    '''
+    Benchmark every case for each (records, beaches) size,
+    yield one result per case. With a database URL, the load path
+    and the sql backend are benchmarked on it too.
+    '''
+    import main, offload, portal_cache
+    from store import build_store, prepare_records
+
+    # the callbacks log every call, layout.py logs as sealice_logger
+    for name in ['beachcleanbay_logger', 'sealice_logger']:
+        logging.getLogger(name).setLevel(logging.WARNING)
+    main.query_backend = 'store'
+    # the callbacks run in this process, on the store installed below,
+    # and render the figures instead of reading pre-rendered or cached ones
+    offload.pool_size = offload.background_size = 0
+    main.figure_dir = tempfile.mkdtemp()
+    main.snapshot_dir = tempfile.mkdtemp()
+    if database:
+        os.environ['DATABASE_URL'] = database
+    portal_cache.cache_size = 0
+    main.l1_timeout = float('inf')
+    weight, real_beaches = read_csvdata(path)
+    for n_beaches in beaches:
+        for n_records in records:
+            rng = np.random.default_rng(seed)
+            beach_df = synthetic_beaches(real_beaches, n_beaches, rng)
+            df = synthetic_records(weight, beach_df, n_records, rng)
+            start = time.perf_counter()
+            store = build_store(prepare_records(df), beach_df)
+            size = dict(records=n_records, beaches=n_beaches)
+            yield dict(size, name='store.build_store', filters={},
+                       timings=[time.perf_counter() - start], bytes=0)
+            main._l1['store'], main._l1['checked'] = store, time.monotonic()
+            for name, filters, func, args in cases(main, store):
+                timings, size_out = timed(func, *args, repeat=repeat)
+                yield dict(size, name=name, filters=filters, timings=timings, bytes=size_out)
+            if not database:
+                continue
+
+            start = time.perf_counter()
+            load_database(df, beach_df, path)
+            yield dict(size, name='import.import_csv', filters={},
+                       timings=[time.perf_counter() - start], bytes=0)
+            for name, func in [('main.global_store', main.global_store), ('main.caching', main.caching)]:
+                yield dict(size, name=name, filters={}, timings=timed_load(func, repeat), bytes=0)
+            main.query_backend = 'sql'
+            main._beach_count['version'] = None
+            try:
+                for name, filters, func, args in cases(main, store):
+                    timings, size_out = timed(func, *args, repeat=repeat)
+                    yield dict(size, name=name, filters=dict(filters, backend='sql'),
+                               timings=timings, bytes=size_out)
+            finally:
+                main.query_backend = 'store'
+
+####### REPORT ###############
+
+def case_key(result):
+    return (result['name'], result['records'], result['beaches'],
+            json.dumps(result['filters'], sort_keys=True))
+
+def compare(results, baseline, tolerance, floor=1e-3):
+    '''
+    Cases whose best time grew by more than tolerance times
+    the baseline one, and by more than floor seconds
+    '''
+    previous = {case_key(r): r['min'] for r in baseline}
+    return [(r, previous[case_key(r)]) for r in results if case_key(r) in previous
+            and r['min'] > max(tolerance * previous[case_key(r)], previous[case_key(r)] + floor)]
+
+def read_results(path):
+    with open(path) as f:
+        return [r for r in map(json.loads, f) if 'name' in r]
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the callbacks on synthetic data')
+    parser.add_argument('--records', type=int, nargs='+', default=record_sizes)
+    parser.add_argument('--beaches', type=int, nargs='+', default=beach_sizes)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_output.txt')
+    parser.add_argument('--compare', help='previous output, exit with 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=1.25)
+    parser.add_argument('--database', help='URL of a scratch Postgres database, its tables are '
+                        'replaced by the synthetic data to time the load path and the sql backend, '
+                        'which are not timed without it')
+    args = parser.parse_args(argv)
+
+    results = []
+    with open(args.output, 'w') as out:
+        out.write(json.dumps({'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                              'python': platform.python_version(),
+                              'pandas': pd.__version__, 'numpy': np.__version__,
+                              'repeat': args.repeat, 'seed': args.seed,
+                              'database': args.database is not None}) + '\n')
+        for result in run(args.records, args.beaches, args.repeat, args.seed, database=args.database):
+            result.update(min=min(result['timings']), median=statistics.median(result['timings']))
+            results.append(result)
+            out.write(json.dumps(result) + '\n')
+            out.flush()
+            print(f"{result['records']:>9} {result['beaches']:>6} {result['name']:<26} "
+                  f"{result['median']*1e3:9.2f} ms {json.dumps(result['filters'])}")
+
+    if args.compare:
+        slower = compare(results, read_results(args.compare), args.tolerance)
+        for result, previous in slower:
+            print(f"REGRESSION {result['name']} {result['records']} {result['beaches']} "
+                  f"{json.dumps(result['filters'])}: {previous*1e3:.2f} -> {result['min']*1e3:.2f} ms")
+        return 1 if slower else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
@@ -1,4 +1,4 @@
-import os, logging
+import os, logging, threading
 from sqlalchemy import Column, create_engine, Date, Float, Integer, Sequence, String
 from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.orm import declarative_base
@@ -45,6 +45,18 @@ class Beach(Base):
     def __repr__(self):
         return f"<Beach(Beach={self.Beach}, Lat={self.Lat} Lon={self.Lon}>"
 
+# One pooled engine per database URL for the whole process,
+# connections are checked before use since the server may drop idle ones
+_engines = {}
+_engines_lock = threading.Lock()
+
+def _dispose_after_fork():
+    # a forked worker must open its own connections, not reuse the parent's
+    for engine in _engines.values():
+        engine.dispose(close=False)
+
+os.register_at_fork(after_in_child=_dispose_after_fork)
+
 def init_db(drop=False):
     db_url = os.getenv('DATABASE_URL')
     # logger.debug(f'URL: {db_url}')
@@ -54,8 +66,12 @@ def init_db(drop=False):
     # DATABASE_URL uses postgres:// but SQLAlchemy only accepts postgresql://
     db_url = db_url.replace('postgres://', 'postgresql://')
 
-    engine = create_engine(db_url)
-    logger.info('Engine created')
+    with _engines_lock:
+        engine = _engines.get(db_url)
+        if engine is None:
+            engine = _engines[db_url] = create_engine(db_url, pool_pre_ping=True,
+                                                      pool_size=5, max_overflow=10)
+            logger.info('Engine created')
     if (drop):
         logger.info('Base dropped')
         Base.metadata.drop_all(engine)
@@ -1,32 +1,121 @@
-import pandas as pd
+import argparse, os, sys, time
+from sqlalchemy import Column, MetaData, Table, Text, cast, delete, func, select, text
+from sqlalchemy.dialects.postgresql import array, insert
 from sqlalchemy.orm import sessionmaker
-from db import init_db, Beach, TeamMember, WeightData
+from db import init_db, Base, Beach, TeamMember, WeightData
 
-def import_csv():
-    print("Importing CSV data")
-    return {
-        "team": pd.read_csv("csvdata/Team_members.csv", header=None, names=["Id", "Name", "Team"]),
-        "weight": pd.read_csv("csvdata/WeightData.csv", header=None, names=["Id", "Beach", "Lat", "Longit", "Weight", "Dates", "team", "person"]),
-        "beach": pd.read_csv("csvdata/Beach2coord.csv", header=None, names=["Id", "Beach", "Lat", "Lon", "Country", "State"]),
-    }
+# CSV file and its columns for each table, the files have no header
+csv_files = {
+    TeamMember: ("Team_members.csv", ["Id", "Name", "Team"]),
+    WeightData: ("WeightData.csv", ["Id", "Beach", "Lat", "Longit", "Weight", "Dates", "team", "person"]),
+    Beach: ("Beach2coord.csv", ["Id", "Beach", "Lat", "Lon", "Country", "State"]),
+}
 
-def insert_data(engine, data):
-    with engine.connect() as conn, conn.begin():
-        print("Inserting TeamMember data")
-        data["team"].to_sql(TeamMember.__tablename__, conn, if_exists="replace", index_label="Id", index=False)
+# Columns of the tables computed from the CSV columns
+derived_columns = {
+    WeightData: {"Teams": lambda row: func.array_remove(array([row["team"]]), None)},
+}
 
-        print("Inserting WeightData data")
-        data["weight"].to_sql(WeightData.__tablename__, conn, if_exists="replace", index_label="Id", index=False)
+class Progress:
+    '''
+    File read by COPY, printing how much of it was sent
+    '''
+    def __init__(self, f, name, step=0.05):
+        self.f, self.name = f, name
+        self.size = max(os.fstat(f.fileno()).st_size, 1)
+        self.done, self.step, self.next = 0, step, step
+        self.start = time.monotonic()
 
-        print("Inserting Beach data")
-        data["beach"].to_sql(Beach.__tablename__, conn, if_exists="replace", index_label="Id", index=False)
-    
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.done += len(data)
+        if data and self.done / self.size >= self.next:
+            self.next = min(self.done / self.size + self.step, 1.)
+            rate = self.done / 2**20 / max(time.monotonic() - self.start, 1e-6)
+            print(f"  {self.name}: {self.done / self.size:4.0%} sent, {rate:.1f} MB/s", flush=True)
+        return data
 
-def run():
-    engine = init_db(drop=True)
+def staging_table(model, columns):
+    '''
+    Temporary table receiving the raw CSV text
+    '''
+    return Table(f"{model.__tablename__}_import", MetaData(),
+                 *[Column(c, Text) for c in columns], prefixes=["TEMPORARY"])
 
-    data = import_csv()
-    insert_data(engine, data)
+def load_table(conn, model, path, columns, mode="replace", chunk=2**20):
+    '''
+    Stream a CSV file into the table of model with COPY.
+    The file goes through a text staging table so empty fields become NULL
+    and the values are cast to the declared column types.
+    mode: replace empties the table first, append skips the rows
+    conflicting with existing ones, upsert updates them from the file.
+    Rows of the file sharing a unique key other than Id are loaded once.
+    '''
+    table = model.__table__
+    staging = staging_table(model, columns)
+    staging.create(conn)
+    with open(path, "rb") as f:
+        conn.connection.cursor().copy_expert(
+            f'COPY "{staging.name}" FROM STDIN WITH (FORMAT csv)', Progress(f, os.path.basename(path)), chunk)
+
+    row = {c: func.nullif(staging.c[c], "") for c in columns}
+    values = {c: cast(row[c], table.c[c].type) for c in columns}
+    values.update({c: make(values) for c, make in derived_columns.get(model, {}).items()})
+    source = select(*[v.label(c) for c, v in values.items()])
+    # the other unique keys (Beach2coord.Beach) keep one row of the file
+    # per key, the one with the highest Id
+    keys = [c.name for c in table.c if c.unique and not c.primary_key and c.name in columns]
+    if keys:
+        source = source.distinct(*[staging.c[c] for c in keys]).order_by(
+            *[staging.c[c] for c in keys], values["Id"].desc())
+    if mode == "replace":
+        conn.execute(text(f'TRUNCATE "{table.name}"'))
+    elif mode == "upsert" and keys:
+        # a key already held by a row of another Id would fail the upsert
+        # on Id, the file wins and that row is deleted
+        incoming = source.subquery()
+        for c in keys:
+            conn.execute(delete(table).where(table.c[c] == incoming.c[c], table.c.Id != incoming.c.Id))
+    stmt = insert(table).from_select(list(values), source)
+    if mode == "upsert":
+        stmt = stmt.on_conflict_do_update(index_elements=[table.c.Id],
+                                          set_={c: stmt.excluded[c] for c in values if c != "Id"})
+    else:
+        stmt = stmt.on_conflict_do_nothing()
+    loaded = conn.execute(stmt).rowcount
+    sent = conn.execute(select(func.count()).select_from(staging)).scalar()
+    staging.drop(conn)
+
+    # keep the Id sequence ahead of the imported Ids
+    sequence = table.c.Id.default
+    conn.execute(select(func.setval(f'"{sequence.name}"', select(func.max(table.c.Id)).scalar_subquery())))
+    print(f"  {table.name}: {loaded} of {sent} rows loaded" +
+          (f", {sent - loaded} conflicting rows skipped" if sent > loaded else ""))
+    return loaded
+
+def import_csv(engine, path="csvdata", mode="replace", models=None, chunk=2**20):
+    '''
+    Load the CSV files of path into the declared tables in one transaction
+    '''
+    Base.metadata.create_all(engine)
+    start = time.monotonic()
+    with engine.begin() as conn:
+        for model, (name, columns) in csv_files.items():
+            if models is None or model.__tablename__ in models:
+                print(f"Importing {name} into {model.__tablename__} ({mode})")
+                load_table(conn, model, os.path.join(path, name), columns, mode, chunk)
+    print(f"Import done in {time.monotonic() - start:.1f} s")
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description="Import the CSV data with COPY")
+    parser.add_argument("--path", default="csvdata", help="directory of the CSV files")
+    parser.add_argument("--mode", choices=["replace", "append", "upsert"], default="replace")
+    parser.add_argument("--tables", nargs="+", choices=[m.__tablename__ for m in csv_files])
+    parser.add_argument("--chunk", type=int, default=1, help="MB sent to COPY at once")
+    args = parser.parse_args(argv)
+
+    engine = init_db()
+    import_csv(engine, args.path, args.mode, args.tables, args.chunk * 2**20)
 
     Session = sessionmaker(bind=engine)
     session = Session()
@@ -41,4 +130,4 @@ def run():
 
 
 if __name__ == '__main__':
-    run()
+    run(sys.argv[1:])
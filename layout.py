@@ -7,6 +7,8 @@ import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 import pandas as pd
 import logging
+import metrics
+import payload
 from colorcet import *
 import numpy as np
 
@@ -37,6 +39,10 @@ def toast_content():
                          id='switch_all_teams',
                          on=True,
                          label="Use all the teams"),
+                     daq.BooleanSwitch(
+                         id='switch_raster',
+                         on=False,
+                         label="Show the density"),
                      ], xs=6, md=2),
                  dbc.Col([
                      dcc.Slider(
@@ -132,26 +138,32 @@ def tab1_content(intro):
     ])
     return tab1_layout
 
-def Mk_map_weight(grouped, txt, sizeref,col):
+@metrics.timed('figure_seconds')
+@payload.compact_figure
+def Mk_map_weight(grouped, txt, sizeref,col, layers=None):
     '''
-    Make a map of plastic accumulations
+    Make a map of plastic accumulations,
+    with image layers the points are only kept for the hover
     '''
     logger.info('Build the portal map')
     plastic_map=go.Figure(go.Scattermapbox(
                      lon=grouped['Longit'],
                      lat=grouped['Lat'],
                      text=grouped['Beach'],
+                     customdata=grouped.get('Beaches'),
                      hovertemplate=txt,
                      marker=dict(
                             size=grouped[col].values.astype('float'),
                             color=grouped[col].values.astype('float'),
                             colorscale=bmy, #'orange',
                             sizemode='area',
-                            sizeref=sizeref)))
+                            sizeref=sizeref,
+                            opacity=0 if layers else None)))
 
     plastic_map.update_layout(
         #height=700,
         hovermode='closest',
+        uirevision='portal', # keep the view when the points follow it
         margin=dict(b=1, l=1, r=1, t=1),
         paper_bgcolor='#003380',
         mapbox=dict(
@@ -162,14 +174,23 @@ def Mk_map_weight(grouped, txt, sizeref,col):
                     ),
                     pitch=0,
                     zoom=4,
+                    layers=layers,
                     style="open-street-map",)) #stamen-toner"
     return plastic_map
 
-def mk_general_curves(df):
+def period_sums(monthly):
+    '''
+    Monthly and yearly weight, indexed by the end of the period,
+    from monthly sums (Dates, Weight)
+    '''
+    new_df=monthly.set_index('Dates')[['Weight']]
+    return new_df.groupby(pd.Grouper(freq="M")).sum(), new_df.groupby(pd.Grouper(freq="Y")).sum()
+
+@metrics.timed('figure_seconds')
+@payload.compact_figure
+def mk_general_curves(monthly):
     logger.info('Build the portal curves')
-    new_df=df.set_index('Dates')
-    Gm=new_df.groupby(pd.Grouper(freq="M")).sum()
-    Gy=new_df.groupby(pd.Grouper(freq="Y")).sum()
+    Gm, Gy= period_sums(monthly)
     # Gr["year"]=datetime(year=Gr.index.get_level_values(0))
     minx,maxx=datetime(year=2017,month=9,day=1),datetime.now()
     fig=go.Figure()    
@@ -207,11 +228,27 @@ def tab2_content():
         dbc.CardHeader('Individual beach statistics'),
         dbc.CardBody([
             dbc.Row([
-                dcc.Dropdown(
-                    id='beach-choice',
-                    # options=mk_beach_dropdown(),
-                    value='Balnakeil'
-                ),
+                dbc.Col([
+                    dcc.Dropdown(
+                        id='beach-country',
+                        placeholder='Country',
+                    ),
+                ], width=3),
+                dbc.Col([
+                    dcc.Dropdown(
+                        id='beach-state',
+                        placeholder='State',
+                    ),
+                ], width=3),
+                dbc.Col([
+                    dcc.Dropdown(
+                        id='beach-choice',
+                        placeholder='Search a beach',
+                        value='Balnakeil'
+                    ),
+                ], width=6),
+            ]),
+            dbc.Row([
                 dcc.Graph(
                     id='beach-statistic',
                 )
@@ -219,16 +256,13 @@ def tab2_content():
         ])
     ])
 
-def draw_stat_curve(df_beach, fig, beach):
+@metrics.timed('figure_seconds')
+@payload.compact_figure
+def draw_stat_curve(df_beach, fig, beach, monthly=None):
         logger.info('draw stat curves')
-        df_beach['Cum_weight']=df_beach['Weight'].cumsum()
-        rates=  pd.Series(df_beach['Weight'].values, index=df_beach['Dates'])
-        New_Dates=df_beach['Dates'][:-1]+df_beach['Dates'].diff()[1:].values/2
-        daily_rate=rates.values[1:]/ \
-                   (df_beach['Dates'].diff()[1:].values.astype('float')/(1e9*3600*24))
-        new_df=df_beach.set_index('Dates')
-        Gm=new_df.groupby(pd.Grouper(freq="M")).sum()
-        Gy=new_df.groupby(pd.Grouper(freq="Y")).sum()
+        # Cum_weight, Rate and Mid come precomputed with the daily weights
+        rates= df_beach.iloc[1:]
+        Gm, Gy= period_sums(df_beach if monthly is None else monthly)
         fig.append_trace(
             go.Scatter(
                 x=df_beach['Dates'],
@@ -243,8 +277,8 @@ def draw_stat_curve(df_beach, fig, beach):
             row=3, col=1)
 
         fig.append_trace(
-             go.Scatter(x= New_Dates,
-                         y=daily_rate,
+             go.Scatter(x= rates['Mid'],
+                         y=rates['Rate'],
                          line=dict(color='firebrick'),
                          yaxis='y2',
                          name= 'kg/d',
@@ -329,7 +363,7 @@ def tab3_content():
                                      dbc.CardBody([
                                          dcc.Dropdown(
                                              id='beach-choice-map',
-                                             #options=mk_beach_dropdown(),
+                                             placeholder='Search a beach',
                                              value='Balnakeil'
                                              ),
                                          dcc.Graph(
@@ -430,8 +464,8 @@ def tab3_content():
                         #color='red',
                     ),
                     html.H3('Nearest recorded beaches'),
-                    html.P(id='nearest_records')
-                    # make a warning
+                    html.P(id='nearest_records'),
+                    dbc.Alert(id='site_warning', color='warning', is_open=False),
                                            
                     ]),
                 ]),
@@ -440,20 +474,29 @@ def tab3_content():
         ])
     ])
 
-def Mk_base_map(grouped):
-    logger.info('Draw basemap')
-    base_map=go.Figure()
-    base_map.add_trace(
-        go.Scattermapbox(
+@metrics.timed('figure_seconds')
+@payload.compact_figure
+def mk_base_points(grouped):
+    '''
+    Beaches (or clusters of beaches) of the input map
+    '''
+    return go.Scattermapbox(
             lon=grouped['Longit'],
             lat=grouped['Lat'],
             text=grouped['Beach'],
+            customdata=grouped.get('Beaches'),
             hovertemplate=
                     "<b>%{text}</b><br>" +
                     "lat: %{lat:.5f}<br>" +
                     "lon: %{lon:.5f}<br><extra></extra>",
             mode='markers')
-                       )
+
+@metrics.timed('figure_seconds')
+@payload.compact_figure
+def Mk_base_map(grouped):
+    logger.info('Draw basemap')
+    base_map=go.Figure()
+    base_map.add_trace(mk_base_points(grouped))
 
     base_map.update_layout(
         height=300,
@@ -475,6 +518,15 @@ def Mk_base_map(grouped):
                   
     return base_map
     
+def mk_nearby_list(names, dist):
+    '''
+    List the recorded beaches near the crosshair
+    '''
+    if not len(names):
+        return 'No recorded beach nearby'
+    return html.Ul([html.Li(f'{name}: {d:.2f} km') for name, d in zip(names, dist)])
+
+@metrics.timed('figure_seconds')
 def mk_crossair(stream, fig):
     '''
     Make a crossair in the middle of the map to locate precisely.
@@ -12,13 +12,13 @@
 #
 # Copyright 2022, Julien Moreau, Plastic@Bay CIC
 
-import os, logging
+import hashlib, os, logging, threading, time, uuid, zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import orjson
 import pandas as pd
-# import datashader as DS
 import plotly.graph_objects as go
 import plotly.io as pio
-# from colorcet import fire
-# from datashader import transfer_functions as tf
 from datetime import datetime, timedelta
 # import os.path
 # from pyproj import Proj
@@ -27,13 +27,27 @@ from dash import dcc as dcc
 from dash import html as html
 from dash import dash_table as d_t
 from dash import ctx as ctx
+from dash import Patch
 import dash_daq as daq
 from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
 import dash_bootstrap_components as dbc
-from flask_caching import Cache
 
-from db import init_db
+from sqlalchemy import select
+
+import metrics
+import offload
+import payload
+import portal_cache
+import queries
+from db import init_db, Beach, WeightData
 from layout import *
+from raster import raster_layers
+from store import (attach_store, beach_rates, beach_records, build_daily, build_store,
+                   cluster_beaches, cluster_max_points, concat_records, cube_select,
+                   current_version, daily_records, drop_current, haversine, map_view, merge_store,
+                   monthly_select, nearest_sites, prepare_records, publish_store, search_beaches,
+                   search_limit, store_lock, view_bounds)
 
 # mysql> show tables;
 # +--------------------------+
@@ -100,48 +114,330 @@ app = dash.Dash(__name__,
                 external_stylesheets=[dbc.themes.BOOTSTRAP, 'assets/style.css'],
                 meta_tags=[{"name": "viewport", "content": "width=device-width, initial-scale=1"}])
 server=app.server
-cache = Cache(app.server, config={
-    'CACHE_TYPE': 'filesystem',
-    'CACHE_DIR': '/tmp'
-})
+metrics.install(server)
+snapshot_dir = '/tmp/beachcleanbay'
+figure_dir = '/tmp/beachcleanbay_figures'
 timeout = 600
+l1_timeout = 30
+refresh_margin = 120
+full_reload_timeout = 6 * 3600
+nearby_km = 10
+duplicate_km = 0.5
+# 'sql' runs the aggregations in the database instead of the cached store
+query_backend = os.getenv('QUERY_BACKEND', 'store')
 
 ##################### CACHE  #########################
 
-def global_store():
+load_chunk = 100_000
+
+def read_weight_data(engine, after=None):
+    '''
+    Weight records (with an Id above after) read through a server-side
+    cursor, each chunk of load_chunk rows is typed as soon as it arrives
+    so the raw rows of the whole table are never held at once
+    '''
+    query = select(WeightData)
+    if after is not None:
+        query = query.where(WeightData.Id > after)
+    with engine.connect().execution_options(stream_results=True, max_row_buffer=load_chunk) as cnx:
+        chunks = [prepare_records(chunk) for chunk in pd.read_sql(query, cnx, chunksize=load_chunk)]
+    if not chunks:
+        return prepare_records(pd.DataFrame(columns=WeightData.__table__.columns.keys()))
+    return concat_records(*chunks)
+
+def read_beaches(engine, after=None):
+    '''
+    Beach properties (with an Id above after)
+    '''
+    query = select(Beach)
+    if after is not None:
+        query = query.where(Beach.Id > after)
+    with engine.connect() as cnx:
+        return pd.read_sql(query, cnx)
+
+@metrics.timed('store_seconds')
+def global_store(previous=None):
     '''
     Caching the dataframe of weight (df), 
-    beach properties (beaches) 
-    and grouping cumulative weight for each beach.
+    beach properties (beaches)
+    and the aggregates built on them (see store.build_store).
+    With a previous store, only the rows above its high-water mark
+    on Id are fetched and merged in. A full reload still happens every
+    full_reload_timeout seconds to pick up edited or deleted rows.
     '''
+    delta = previous is not None and time.time()-previous['loaded'] < full_reload_timeout
+    hwm = previous['hwm'] if delta else {'WeightData': None, 'Beach2coord': None}
     engine = init_db()
-    logger.debug('database initialised')
-    with engine.connect() as cnx:
-        logger.debug('Connected to database')
-        df= pd.read_sql_table('WeightData', cnx)
-        beaches=pd.read_sql_table('Beach2coord', cnx)
-        logger.debug('Dataframes built')
-
-    df['Weight']=df['Weight'].astype('float')
-    df.Dates=pd.to_datetime(df.Dates)
-    grouped = df.groupby(['Beach', 'Lat', 'Longit'])['Weight'].sum().reset_index()
+    # both tables are read at the same time on two pooled connections
+    with ThreadPoolExecutor(2) as pool:
+        records = pool.submit(read_weight_data, engine, hwm['WeightData'])
+        beaches = pool.submit(read_beaches, engine, hwm['Beach2coord'])
+        df, beaches = records.result(), beaches.result()
+    logger.debug('Dataframes built')
+    metrics.inc('rows_loaded_total', len(df), table='WeightData')
+    metrics.inc('rows_loaded_total', len(beaches), table='Beach2coord')
+
+    if not delta:
+        store = build_store(df, beaches)
+    elif len(df) or len(beaches):
+        store = merge_store(previous, df, beaches)
+    else:
+        logger.debug('No new records')
+        store = dict(previous, refreshed=time.time())
     logger.debug('Dataframes ready to be cached')
-    return df, grouped, beaches
+    return store
 
-@cache.memoize(timeout=timeout)
-def caching():
+@metrics.timed('store_seconds')
+def caching(previous=None):
+    '''
+    Build the store and publish it as a memory-mapped snapshot (L2)
+    shared by all the workers, then attach to it so this process
+    does not keep a private copy.
+    '''
     logger.info('Using global store')
-    return global_store()
+    store = global_store(previous)
+    return attach_store(snapshot_dir, publish_store(store, snapshot_dir)) or store
+
+_l1 = {'store': None, 'checked': 0.}
+_load_lock = threading.Lock()
+
+def published_store(current):
+    '''
+    The published store (L2), None when there is none, and whether
+    it was refreshed recently enough to be served
+    '''
+    version, refreshed = current_version(snapshot_dir)
+    if current is not None and version == current['version']:
+        store = current
+    else:
+        store = attach_store(snapshot_dir, version) if version else None
+    return store, store is not None and time.time()-refreshed <= timeout-refresh_margin
+
+def refresh_store(full=False):
+    '''
+    Bring the in-process store (L1) up to date. Only one load runs
+    per process: concurrent callers wait and reuse its result.
+    The store is attached from the L2 when another worker published it,
+    and rebuilt from the database before it gets older than timeout.
+    Only one worker loads at a time, the others wait on the store lock
+    and attach what it published.
+    '''
+    with _load_lock:
+        current = _l1['store']
+        if not full and current is not None and time.monotonic()-_l1['checked'] < l1_timeout:
+            return current
+        store, fresh = (None, False) if full else published_store(current)
+        rebuilt = False
+        if not fresh:
+            with store_lock(snapshot_dir):
+                # another worker may have published while this one waited
+                store, fresh = (None, False) if full else published_store(current)
+                if not fresh:
+                    metrics.inc('cache_requests_total', cache='l2', result='miss')
+                    previous = None if full else store or current
+                    store = caching(previous)
+                    rebuilt = previous is None or store['version'] != previous['version']
+        if fresh:
+            metrics.inc('cache_requests_total', cache='l2', result='hit')
+        _l1['store'], _l1['checked'] = store, time.monotonic()
+        # only the web worker that published the store pre-renders it
+        if rebuilt and query_backend == 'store' and not offload.in_worker:
+            threading.Thread(target=prerender_all, args=(store,), daemon=True).start()
+        return store
+
+def background_refresh(full=False):
+    try:
+        refresh_store(full)
+    except Exception:
+        logger.exception('Store refresh failed, serving the previous store')
+
+def invalidate_store(full=False):
+    '''
+    Unpublish the shared store and rebuild it in the background.
+    The previous store is served until the new one is ready.
+    full: reload every table instead of merging the new rows.
+    '''
+    logger.info('Store invalidated')
+    drop_current(snapshot_dir)
+    _l1['checked'] = 0.
+    threading.Thread(target=background_refresh, args=(full,), daemon=True).start()
+
+def get_store():
+    '''
+    Store used by the callbacks. Only the first call of a process waits
+    for a load, afterwards the current store is returned straight away
+    and refreshed in the background once it is older than l1_timeout.
+    Callback workers do not refresh it, they serve the version pinned
+    by each request (see pin_store).
+    '''
+    store = _l1['store']
+    metrics.inc('cache_requests_total', cache='l1', result='miss' if store is None else 'hit')
+    if store is None:
+        return refresh_store()
+    if not offload.in_worker and time.monotonic()-_l1['checked'] > l1_timeout \
+            and not _load_lock.locked():
+        threading.Thread(target=background_refresh, daemon=True).start()
+    return store
+
+def pin_store(version):
+    '''
+    In a callback worker, make get_store serve the store of version,
+    the one the web worker answered the request with, so the results
+    match the version they are cached under.
+    False when that version is no longer published, the caller then
+    drops the request (PreventUpdate) so nothing is cached under it.
+    '''
+    if not offload.in_worker or query_backend != 'store':
+        return True
+    with _load_lock:
+        store = _l1['store']
+        if store is None or store['version'] != version:
+            store = attach_store(snapshot_dir, version)
+            if store is None:
+                logger.debug(f'Store {version} is gone, dropping the request')
+                return False
+            _l1['store'] = store
+        _l1['checked'] = time.monotonic()
+    return True
+
+##################### DATA ACCESS  #########################
+
+def portal_stats(year, sw_year, team, sw_team):
+    '''
+    Statistics of each beach for the selected year and team
+    '''
+    if query_backend == 'sql':
+        with init_db().connect() as cnx:
+            return queries.beach_stats(cnx, year, team, sw_year, sw_team)
+    return cube_select(get_store(), year, team, all_years=sw_year, all_teams=sw_team)
+
+def portal_records(year, sw_year, team, sw_team):
+    '''
+    Monthly sums of the records of the selected year and team
+    for the trend curve
+    '''
+    if query_backend == 'sql':
+        with init_db().connect() as cnx:
+            return queries.monthly_weight(cnx, year, team, sw_year, sw_team)
+    return monthly_select(get_store(), year, team, all_years=sw_year, all_teams=sw_team)
+
+def beach_monthly(beach):
+    '''
+    Monthly sums of the records of a beach
+    '''
+    if query_backend == 'sql':
+        with init_db().connect() as cnx:
+            return queries.monthly_weight(cnx, beach=beach)
+    return monthly_select(get_store(), None, None, beach=beach)
+
+def portal_rates(year, sw_year, team, sw_team):
+    '''
+    Pollution rate of the beaches cleaned over more than a week
+    for the selected year and team
+    '''
+    if query_backend == 'store' and sw_year and sw_team:
+        return get_store()['rates']
+    return beach_rates(portal_stats(year, sw_year, team, sw_team))
+
+def beach_daily(beach, coordinates=False):
+    '''
+    Weight collected on a beach for each date (and coordinates),
+    per date with its cumulative weight and pollution rate
+    '''
+    if query_backend == 'sql':
+        with init_db().connect() as cnx:
+            daily= queries.daily_weight(cnx, beach, coordinates)
+        return daily if coordinates else build_daily(daily.assign(Beach=beach))[0]
+    if not coordinates:
+        return daily_records(get_store(), beach)
+    return beach_records(get_store(), beach) \
+                .groupby(['Dates','Lat', 'Longit'])[['Weight']].agg('sum').reset_index()
+
+def beach_totals():
+    '''
+    Cumulative weight for each beach
+    '''
+    if query_backend == 'sql':
+        with init_db().connect() as cnx:
+            return queries.beach_stats(cnx)
+    return get_store()['grouped']
+
+_beach_count = {'version': None, 'count': 0}
+
+def many_beaches():
+    '''
+    Whether the maps have too many beaches to draw them all
+    and only show the ones of their view. The database is
+    counted once per data version.
+    '''
+    if query_backend == 'sql':
+        version = data_version()
+        if _beach_count['version'] != version:
+            with init_db().connect() as cnx:
+                _beach_count.update(version=version, count=queries.beach_count(cnx))
+        return _beach_count['count'] > cluster_max_points
+    return len(get_store()['grouped']) > cluster_max_points
+
+def nearby_sites(lat, lon, k=5, radius_km=nearby_km):
+    '''
+    Names and distances (km) of the k beach sites
+    nearest to (lat, lon) within radius_km
+    '''
+    if query_backend == 'sql':
+        with init_db().connect() as cnx:
+            beaches= queries.beaches_near(cnx, lat, lon, radius_km)
+        dist= haversine(lat, lon, beaches['Lat'].values, beaches['Lon'].values)
+        near= np.flatnonzero(dist <= radius_km)
+        near= near[np.argsort(dist[near], kind='stable')][:k]
+        return beaches['Beach'].values[near], dist[near]
+    store= get_store()
+    rows, dist= nearest_sites(store, lat, lon, k, radius_km)
+    return store['beaches']['Beach'].values[rows], dist
+
+def data_version():
+    '''
+    Changes whenever the data seen by the callbacks may have changed
+    '''
+    if query_backend == 'sql':
+        return int(time.time() // timeout)
+    return get_store()['version']
+
+def beach_search(text, k=search_limit, country=None, state=None):
+    '''
+    The k beaches (Beach, Country, State) best matching text
+    in country and state
+    '''
+    if query_backend == 'sql':
+        with init_db().connect() as cnx:
+            return queries.search_beaches(cnx, text, k, country, state)
+    return search_beaches(get_store(), text, k, country, state)
+
+def beach_facets(country=None):
+    '''
+    Countries of the beaches, or the states of country
+    '''
+    if query_backend == 'sql':
+        with init_db().connect() as cnx:
+            return queries.beach_facets(cnx, country)
+    search= get_store()['search']
+    if country:
+        return sorted(search.loc[search['Country'] == country, 'State'].dropna().unique())
+    return sorted(search['Country'].dropna().unique())
+
+def team_list():
+    if query_backend == 'sql':
+        with init_db().connect() as cnx:
+            return queries.team_names(cnx)
+    return get_store()['teams']
 
 
 def get_beach_data(beach):
     logger.info(f'Acquiring data from {beach}')
-    df,_,_=caching()
-    df_beach= df[(df==beach).any(axis=1)].sort_values(by=['Dates']) \
-                .groupby(['Dates','Lat', 'Longit'])[['Weight']].agg('sum').reset_index()
+    df_beach= beach_daily(beach, coordinates=True)
     if len(df_beach['Longit'])>0:
         logger.debug(f'{beach} contains data')
-        lon,lat=df_beach['Longit'][0],df_beach['Lat'][0]
+        # the store holds float32 coordinates, show them as entered
+        lon,lat=(round(float(df_beach[c][0]), payload.coordinate_decimals) for c in ('Longit', 'Lat'))
         last_entry_dates=pd.to_datetime(df_beach['Dates'])[-50:]
         last_entry_weight=df_beach['Weight'][-50:]
         last_record= 'Last record in {}:   {} --- {} kg.'.format(
@@ -154,18 +450,109 @@ def get_beach_data(beach):
             margin=dict(b=1, l=1, r=5, t=30),
             yaxis=dict(title='Weight collected (kg)')
             )
-        return last_record, summary, lon,lat
+        return last_record, payload.compact(summary), lon,lat
     else:
         logger.debug(f'{beach} has no data')
         return 'No record', {}, None, None
     
-def mk_beach_dropdown():
+##################### PRE-RENDERED FIGURES  #########################
+# The figures of each beach are rendered after the store is rebuilt and
+# written to figure_dir under a fingerprint of the beach records, so
+# only the beaches whose records changed are rendered again and all the
+# workers serve the same files.
+
+figure_format = 3   # change when the beach figures change
+prerender_chunk = 50
+
+def record_hashes(records):
+    return pd.util.hash_pandas_object(records[['Dates', 'Lat', 'Longit', 'Weight']], index=False).values
+
+def figure_path(beach, hashes):
     '''
-    Get the name of all the beaches and collect them in a dictionary
+    File of the figures of a beach, from the hashes of its records
     '''
-    logger.info('Gathering the beach names')
-    _, grouped,_=caching()
-    return grouped['Beach'].array
+    name = hashlib.sha1(beach.encode()).hexdigest()[:20]
+    fingerprint = f'{int(hashes.sum(dtype=np.uint64)):016x}-{len(hashes)}'
+    return os.path.join(figure_dir, f'{name}-{figure_format}-{fingerprint}.json.z')
+
+def prerendered(beach, part):
+    '''
+    Pre-rendered figures of a beach ('stats' or 'summary'), None when
+    they are not ready or the data is queried from the database
+    '''
+    if query_backend != 'store' or not beach:
+        return None
+    try:
+        with open(figure_path(beach, record_hashes(beach_records(get_store(), beach))), 'rb') as f:
+            figures = orjson.loads(zlib.decompress(f.read()))
+    except FileNotFoundError:
+        metrics.inc('cache_requests_total', cache='figures', result='miss')
+        return None
+    metrics.inc('cache_requests_total', cache='figures', result='hit')
+    return figures[part]
+
+def prerender_beaches(chunk):
+    '''
+    Render the figures of the beaches of a (version, beaches) chunk
+    that have no file yet, in a background worker. Nothing is rendered
+    once the version is replaced, the pass of the new one renders it.
+    '''
+    version, beaches = chunk
+    if not pin_store(version) or get_store()['version'] != version:
+        return 0
+    store = get_store()
+    rendered = 0
+    for beach in beaches:
+        path = figure_path(beach, record_hashes(beach_records(store, beach)))
+        if os.path.exists(path):
+            continue
+        figures = {'stats': beach_stat_figure(beach), 'summary': get_beach_data(beach)}
+        with open(path + '.tmp', 'wb') as f:
+            f.write(zlib.compress(pio.json.to_json_plotly(figures).encode(), 6))
+        os.replace(path + '.tmp', path)
+        rendered += 1
+    return rendered
+
+def prerender_all(store):
+    '''
+    Pre-render the figures of every beach of store on the background
+    workers, then remove the files of records that are no longer current
+    '''
+    try:
+        os.makedirs(figure_dir, exist_ok=True)
+        beaches = list(store['beach_index'])
+        start = time.monotonic()
+        # at most prerender_chunk beaches per task, and enough tasks
+        # for every background worker
+        size = max(min(prerender_chunk, -(-len(beaches) // max(offload.background_size, 1))), 1)
+        rendered = sum(offload.run_background(prerender_beaches,
+            [(store['version'], beaches[i:i+size]) for i in range(0, len(beaches), size)]))
+        hashes = record_hashes(store['df'])
+        keep = {os.path.basename(figure_path(beach, hashes[lo:hi]))
+                for beach, (lo, hi) in store['beach_index'].items()}
+        for file in os.listdir(figure_dir):
+            if file not in keep:
+                os.remove(os.path.join(figure_dir, file))
+        logger.info(f'Pre-rendered {rendered} of {len(beaches)} beaches in {time.monotonic()-start:.1f} s')
+    except Exception:
+        logger.exception('Pre-rendering the beach figures failed')
+
+def mk_beach_options(matches, text=None, value=None):
+    '''
+    Dropdown options of the matched beaches labelled with their country
+    and state. The typed text joins the search text of each option,
+    otherwise the dropdown would hide the fuzzy matches it does not hold.
+    The selected value stays in the options.
+    '''
+    options=[]
+    for beach, country, state in matches[['Beach', 'Country', 'State']].itertuples(index=False):
+        where=', '.join(str(x) for x in (country, state) if isinstance(x, str) and x)
+        options.append({'label': f'{beach} ({where})' if where else beach,
+                        'value': beach,
+                        'search': f'{beach} {text}' if text else beach})
+    if value and value not in set(matches['Beach']):
+        options.insert(0, {'label': value, 'value': value, 'search': value})
+    return options
 
 
 default_user={'name':'Anonymous'}
@@ -173,8 +560,9 @@ default_user={'name':'Anonymous'}
 
 app.title="Beach Clean Bay"
 header=dcc.Markdown('Beach Clean Bay, _Science with beach and river cleaners_')
-app.layout = dbc.Container([
-    dcc.Store(id='tab3_map', storage_type='session'),
+main_layout = [
+    dcc.Store(id='portal_drawn'),
+    dcc.Store(id='portal_view'),
     dbc.Card([
         dbc.CardHeader([header], className='main-title'),
         ]),
@@ -190,7 +578,16 @@ app.layout = dbc.Container([
             ]),
         dbc.CardFooter([
             footer_content()], className='main-footer')
-])
+]
+
+def serve_layout():
+    '''
+    Layout of each page load, session_id tells the requests
+    of this page from the others
+    '''
+    return dbc.Container([dcc.Store(id='session_id', data=uuid.uuid4().hex)] + main_layout)
+
+app.layout = serve_layout
 
 
 
@@ -200,16 +597,17 @@ app.layout = dbc.Container([
     Output('team_selection', 'options'),
     Input('toast', 'is_open'),
     )
+@metrics.timed('callback_seconds')
 def initialise_dropdown(toast):
     if toast:
         logger.info('Populating teams dropdown')
-        df,_,_= caching()
-        return df.Teams.explode().unique()
+        return team_list()
 
 @app.callback(
     Output('year_slider', 'disabled'),
     Input('switch_all_years','on'),
     )
+@metrics.timed('callback_seconds')
 def activate_year(switch):
     logger.debug('Year slider changed')
     return switch
@@ -218,87 +616,207 @@ def activate_year(switch):
     Output('team_selection', 'disabled'),
     Input('switch_all_teams','on'),
     )
+@metrics.timed('callback_seconds')
 def activate_team(switch):
     logger.debug('Team slider changed')
     return switch
    
+# pans and zooms only reach the server when the drawn map follows the view
+app.clientside_callback(
+    '''
+    function(view, drawn) {
+        if (!drawn || !drawn.view) {
+            return window.dash_clientside.no_update;
+        }
+        return view;
+    }
+    ''',
+    Output('portal_view', 'data'),
+    Input('weight-map', 'relayoutData'),
+    State('portal_drawn', 'data'),
+)
+
 @app.callback(
     Output('weight-map', 'figure'),
-    Output('Total_Portal','value'),
     Output('Total_sites','value'),
-    Output('Total_records','value'),
-    Output("curve_trend", 'figure'),
+    Output('portal_drawn', 'data'),
     Input('year_slider', 'value'),# slider year
     Input('switch_all_years', 'on'),# all years
     Input('team_selection', 'value'),#dropdown teams
     Input('switch_all_teams','on'),# all teams
     Input('radio', 'value'),
+    Input('switch_raster', 'on'),
+    Input('portal_view', 'data'),
+    State('portal_drawn', 'data'),
+    State('session_id', 'data'),
+    State('weight-map', 'relayoutData'),
 )
-def Mk_main_map(year, sw_year, team,sw_team, radio):
+@metrics.timed('callback_seconds')
+def Mk_main_map(year, sw_year, team,sw_team, radio, raster=False, moved=None, drawn=None, session=None, view=None):
+   '''
+   Map of the selected statistic. drawn describes the map in the browser:
+   when only the statistic changed and the beaches shown are the same
+   the figure is patched, when nothing changed it is left as it is.
+   Full figures are cached for the normalized filters.
+   The map only follows the view (portal_view) when it rasters the beaches
+   or holds too many of them to draw them all, like the picker.
+   '''
    logger.info('building the map')
-   df,_,_= caching()
-   if not sw_year:
-       logger.debug(f'Building only for year {year}')
-       df= df[df.Dates.dt.year== year]   
-   if not sw_team:
-       logger.debug(f'Building only for team {team}')
-       df= df[df.Teams.apply(lambda x: team in x)]     
+   follows= bool(raster) or many_beaches()
+   zoom, bounds= map_view(view if follows else None)
+   filters= [year, sw_year, team, sw_team, bool(raster), zoom, bounds and [float(b) for b in bounds]]
+   now= dict(filters=filters, radio=radio, data=data_version(), view=follows)
+   if drawn == now:
+       return dash.no_update, dash.no_update, dash.no_update
+   patch= drawn is not None and dict(drawn, radio=radio) == now and (drawn['radio'] == 'R') == (radio == 'R')
+   key= ('map',)+portal_cache.portal_key(year, sw_year, team, sw_team)+(radio, bool(raster), zoom, str(filters[-1]))
+   cached= None if patch else portal_cache.get(now['data'], key)
+   if cached is not None:
+       return cached[0], cached[1], now
+   fig, sites= draw_main_map(year, sw_year, team, sw_team, radio, raster, zoom, bounds, patch, now['data'], session)
+   if not patch:
+       portal_cache.put(now['data'], key, (fig, sites), data_version())
+   return fig, sites, now
+
+@offload.heavy
+def draw_main_map(year, sw_year, team, sw_team, radio, raster, zoom, bounds, patch, version, session=None):
+   '''
+   Map figure, or a patch of its statistic, and the number of beaches
+   '''
+   if not pin_store(version):
+       raise PreventUpdate
+   if radio == 'R':
+       grouped= portal_rates(year, sw_year, team, sw_team)
+   else:
+       grouped= portal_stats(year, sw_year, team, sw_team)
    if radio == 'W' : 
-       grouped = df.groupby(['Beach', 'Lat', 'Longit'])['Weight'].sum().reset_index()
        txt="<b>%{text}</b><br><br>Weight: %{marker.size:.2f}<br>"
        sizeref=10
        col='Weight'
    elif radio == 'Nb':
-       grouped = df.groupby(['Beach', 'Lat', 'Longit'])['Weight'].count().reset_index()
        txt="<b>%{text}</b><br><br>Count: %{marker.size}<br>"
        sizeref=0.5
-       col='Weight'      
+       col='Count'      
    else:
-       mins=df.groupby(['Beach', 'Lat', 'Longit'])['Dates'].min().reset_index()
-       maxs=df.groupby(['Beach', 'Lat', 'Longit'])['Dates'].max().reset_index()
-       weight=df.groupby(['Beach', 'Lat', 'Longit'])['Weight'].sum().reset_index()
-       weight['dur']=maxs.Dates-mins.Dates
-       grouped=weight[weight.dur>pd.Timedelta('7 day')]
-       grouped['Rates']= grouped.loc[:,'Weight'].values/ \
-                               (grouped.loc[:,'dur'].values/pd.Timedelta('1 day'))
        txt="<b>%{text}</b><br><br>Rates kg/day: %{marker.size:.2f}<br>"
        sizeref=0.04
        col='Rates'
   
-   return [Mk_map_weight(grouped, txt, sizeref, col), 
-          round(df['Weight'].sum()), 
-          len(grouped), len(df), 
-          mk_general_curves(df)]
+   layers= None
+   if raster:
+       key= (version,)+portal_cache.portal_key(year, sw_year, team, sw_team)+(col,)
+       layers= raster_layers(grouped, col, zoom, bounds, key)
+   points= cluster_beaches(grouped, zoom, bounds)
+   if patch:
+       logger.debug('Patching the map statistic')
+       fig= Patch()
+       fig['data'][0]['hovertemplate']= txt
+       values= payload.quantize(points[col].values.astype('float'), payload.value_decimals, payload.value_digits)
+       fig['data'][0]['marker']['size']= values
+       fig['data'][0]['marker']['color']= values
+       fig['data'][0]['marker']['sizeref']= sizeref
+       if raster:
+           fig['layout']['mapbox']['layers']= layers
+   else:
+       fig= Mk_map_weight(points, txt, sizeref, col, layers)
+   return fig, len(grouped)
+
+@app.callback(
+    Output('Total_Portal','value'),
+    Output('Total_records','value'),
+    Output("curve_trend", 'figure'),
+    Input('year_slider', 'value'),# slider year
+    Input('switch_all_years', 'on'),# all years
+    Input('team_selection', 'value'),#dropdown teams
+    Input('switch_all_teams','on'),# all teams
+)
+@metrics.timed('callback_seconds')
+def update_portal_curve(year, sw_year, team,sw_team):
+   '''
+   Portal totals and trend curve, they do not depend on the map settings
+   '''
+   logger.info('building the portal curve')
+   version, key= data_version(), ('curve',)+portal_cache.portal_key(year, sw_year, team, sw_team)
+   cached= portal_cache.get(version, key)
+   if cached is not None:
+       return tuple(cached)
+   grouped= portal_stats(year, sw_year, team, sw_team)
+   total_weight, total_records= round(grouped['Weight'].sum()), int(grouped['Count'].sum())
+   outputs= total_weight, total_records, mk_general_curves(portal_records(year, sw_year, team, sw_team))
+   portal_cache.put(version, key, outputs, data_version())
+   return outputs
+
+@app.callback(
+    Output('beach-country', 'options'),
+    Input('toast', 'is_open'),
+    )
+@metrics.timed('callback_seconds')
+def populate_countries(toast):
+    logger.info('Populate the country facet')
+    return beach_facets()
+
+@app.callback(
+    Output('beach-state', 'options'),
+    Output('beach-state', 'value'),
+    Input('beach-country', 'value'),
+    )
+@metrics.timed('callback_seconds')
+def populate_states(country):
+    return (beach_facets(country) if country else []), None
 
 @app.callback(
     Output('beach-choice', 'options'),
+    Input('beach-choice', 'search_value'),
+    Input('beach-country', 'value'),
+    Input('beach-state', 'value'),
+    State('beach-choice', 'value'),
+    )
+@metrics.timed('callback_seconds')
+def search_beach(text, country, state, value):
+    '''
+    Top matches of the typed text in the selected country and state
+    '''
+    logger.debug(f'Searching the beaches for {text!r}')
+    return mk_beach_options(beach_search(text, country=country, state=state), text, value)
+
+@app.callback(
     Output('beach-choice-map', 'options'),
-    Input('toast', 'is_open'),
+    Input('beach-choice-map', 'search_value'),
+    State('beach-choice-map', 'value'),
     )
-def populate_beach(toast):
-    logger.info('Populate the beach dropdowns')
-    _, grouped,_=caching()
-    return grouped['Beach'].array, grouped['Beach'].array
+@metrics.timed('callback_seconds')
+def search_beach_map(text, value):
+    logger.debug(f'Searching the beaches for {text!r}')
+    return mk_beach_options(beach_search(text), text, value)
 
 @app.callback(
     Output('beach-statistic', 'figure'),
     Input('beach-choice', 'value'),
-    #State('beach-choice', 'value')
+    State('session_id', 'data'),
 )
-def update_cum_curve(beach):
+@metrics.timed('callback_seconds')
+def update_cum_curve(beach, session=None):
     '''
     Make a curve of the cumulative weight collected on a beach
     Calculate the rate of pollution
     '''
     logger.info('Making the beach statistics')
-    df, _,_=caching()
-    df_beach= df[(df==beach).any(axis=1)].sort_values(by=['Dates']) \
-                .groupby(['Dates'])[['Weight']].agg('sum').reset_index()
+    fig= prerendered(beach, 'stats')
+    return draw_beach_stats(beach, data_version(), session) if fig is None else fig
+
+@offload.heavy
+def draw_beach_stats(beach, version, session=None):
+    if not pin_store(version):
+        raise PreventUpdate
+    return beach_stat_figure(beach)
+
+def beach_stat_figure(beach):
+    df_beach= beach_daily(beach)
     fig=make_subplots(rows=3, cols=1,
                     shared_xaxes=True,
                     vertical_spacing=0.05)
     if len(df_beach)>1:
-        fig= draw_stat_curve(df_beach, fig, beach)        
+        fig= draw_stat_curve(df_beach, fig, beach, beach_monthly(beach))
     else:
         fig.update_layout(
             {"title": {"text": "Only one measure, cannot draw the figure",},
@@ -307,65 +825,115 @@ def update_cum_curve(beach):
     return fig
 
 @app.callback(
-    Output('tab3_map','data'),
+    Output('beach_picker', 'figure'),
     Input('toast', 'is_open')
     )
+@metrics.timed('callback_seconds')
 def generate_base_map(toast):
+    '''
+    Draw the base map of the input tab with its crosshair,
+    read_coord then only patches it
+    '''
     logger.info('Making the map for tab3')
-    _, grouped,_=caching()
-    return Mk_base_map(grouped)
+    grouped=beach_totals()
+    lat, lon, fig= mk_crossair(None, Mk_base_map(cluster_beaches(grouped, *map_view(None))))
+    return fig
 
+def picker_points(zoom, bounds):
+    '''
+    Beaches of the picker for a view, None when
+    the base map already holds all of them
+    '''
+    if not many_beaches():
+        return None
+    return mk_base_points(cluster_beaches(beach_totals(), zoom, bounds))
 
 #check coordinates of the map
 @app.callback(
      Output('lat', 'placeholder'),
      Output('lon', 'placeholder'),
-     Output('beach_picker', 'figure'),
+     Output('beach_picker', 'figure', allow_duplicate=True),
      Output('recent_records','figure'),
      Output('latest-record','children'),
      Output('selected_beach','children'),
      Output('osmap_link','href'),
      Output('zoom-indicator', 'value'),
+     Output('nearest_records', 'children'),
+     Output('site_warning', 'children'),
+     Output('site_warning', 'is_open'),
      Input('beach_picker','relayoutData'),    
      Input('beach-choice-map', 'value'),
-     Input('tab3_map','data'),   
+     prevent_initial_call='initial_duplicate',
 )
-def read_coord(stream, beach,state):
+@metrics.timed('callback_seconds')
+def read_coord(stream, beach):
+    '''
+    Follow the beach picker. Its figure is only patched:
+    the crosshair, the view and, when there are many beaches,
+    the points seen, so a pan does not resend the base map.
+    '''
     #print(stream['mapbox._derived'])
     logger.info('Interactivity in input tab')
+    picker= Patch()
     if ctx.triggered_id == 'beach-choice-map':
-        last_record, fig, lon,lat=get_beach_data(beach)
-        state['layout']['mapbox']['center']=dict(
+        last_record, fig, lon,lat=prerendered(beach, 'summary') or get_beach_data(beach)
+        if lat is None:
+            # dropdown cleared, or a beach of the registry without records
+            selection=f'You have selected: {beach}' if beach else 'No beach selected'
+            return None, None, dash.no_update, fig, last_record, selection, dash.no_update, False, \
+                   mk_nearby_list([], []), '', False
+        picker['layout']['mapbox']['center']=dict(
                         lat=lat,
                         lon=lon,)
-        state['layout']['mapbox']['zoom']=10
+        picker['layout']['mapbox']['zoom']=10
+        points= picker_points(10, view_bounds(lat, lon, 10))
+        if points is not None:
+            picker['data'][0]=points
+        names, dist= nearby_sites(lat, lon, k=6)
+        nearby= mk_nearby_list(names[names != beach][:5], dist[names != beach][:5])
         selection=f'You have selected: {beach}'
         href=f'https://explore.osmaps.com/?lat={lat}&lon={lon}&zoom=14&overlays=&style=Standard&type=2d&placesCategory='
-        return lat, lon, state , fig, last_record,selection, href, False         
+        return lat, lon, picker , fig, last_record,selection, href, False, nearby, '', False
     else:
         #print('stream: ',stream)
-        lat, lon,beachpicker= mk_crossair(stream, state)
-        summary= go.Figure()
-        summary.update_layout(
-            title='no beach selected',
-            height=200,
-            margin=dict(b=1, l=1, r=1, t=30),
-        )
+        lat, lon,picker= mk_crossair(stream, picker)
+        zoom, bounds= map_view(stream)
+        points= picker_points(zoom, bounds) if stream is not None else None
+        if points is not None:
+            picker['data'][0]=points
+        if stream is None:
+            # first call, generate_base_map draws the figure
+            picker= dash.no_update
+        summary= Patch()
+        summary['data']= []
+        summary['layout']['title']= 'no beach selected'
+        summary['layout']['yaxis']= {}
         href=f'https://explore.osmaps.com/?lat={lat}&lon={lon}&zoom=14&overlays=&style=Standard&type=2d&placesCategory='
-        if state['layout']['mapbox']['zoom']>11:
+        if zoom>11:
             indic=True
         else:
             indic=False
-        return  lat, lon,beachpicker, summary, '', 'No beach selected', href,indic 
+        names, dist= nearby_sites(lat, lon)
+        warning= ''
+        if len(dist) and dist[0]<=duplicate_km:
+            warning= (f'{names[0]} is recorded {dist[0]*1000:.0f} m away, '
+                      'check it is not the same site before registering a new one.')
+        return  lat, lon,picker, summary, '', 'No beach selected', href,indic, \
+                mk_nearby_list(names, dist), warning, bool(warning)
 
 @app.callback(
     Output('beach-choice-map', 'value'),
     Input('beach_picker','clickData'),
 )
+@metrics.timed('callback_seconds')
 def select_from_map(click):
     if click is not None:
+        point= click['points'][0]
+        if point.get('customdata', 1) > 1:
+            # a cluster of beaches, zoom in to pick one
+            return dash.no_update
         logger.info('Get selected beach data')
-        return click['points'][0]['text']
+        return point['text']
        
 
 if __name__ == '__main__':
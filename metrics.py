@@ -0,0 +1,195 @@
+'''
+Metrics of the app in the Prometheus text format, served on /metrics.
+
+Each process (gunicorn workers, callback and background workers) keeps
+its own counts and writes them to its file of METRICS_DIR after the
+requests and tasks that changed them, a scrape sums the files of all
+the processes. The files of dead processes are kept so the counters
+never go back, the directory is emptied with /tmp. Recording costs a
+perf_counter call and a dict update, the text is only built when
+/metrics is read. METRICS=0 turns the recording off.
+'''
+import bisect, functools, json, logging, os, tempfile, threading, time, uuid
+import flask
+
+logger = logging.getLogger('beachcleanbay_logger')
+
+namespace = 'beachcleanbay'
+enabled = os.getenv('METRICS', '1') != '0'
+
+latency_buckets = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60.)
+size_buckets = (1e3, 1e4, 3e4, 1e5, 3e5, 1e6, 3e6, 1e7)
+
+# name: (type, help, buckets)
+_metrics = {
+    'callback_seconds': ('histogram', 'Run time of the Dash callbacks', latency_buckets),
+    'figure_seconds': ('histogram', 'Time to build the figures', latency_buckets),
+    'store_seconds': ('histogram', 'Time to load and publish the store', latency_buckets),
+    'response_bytes': ('histogram', 'Size of the callback responses', size_buckets),
+    'payload_saved_bytes': ('histogram', 'Bytes saved by compacting the figures', size_buckets),
+    'cache_requests_total': ('counter', 'Cache lookups by cache and result', None),
+    'rows_loaded_total': ('counter', 'Rows read from the database by table', None),
+}
+
+directory = os.getenv('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'beachcleanbay_metrics'))
+
+_values = {}
+_lock = threading.Lock()
+_state = {'file': None, 'dirty': False}
+
+def _forget():
+    # a forked child starts with no counts and its own file
+    _values.clear()
+    _state.update(file=None, dirty=False)
+
+os.register_at_fork(after_in_child=_forget)
+
+def observe(name, value, **labels):
+    '''
+    Add a value to the histogram name
+    '''
+    if not enabled:
+        return
+    buckets = _metrics[name][2]
+    key = (name, tuple(sorted(labels.items())))
+    i = bisect.bisect_left(buckets, value)
+    with _lock:
+        counts = _values.get(key)
+        if counts is None:
+            # one count per bucket and +Inf, then the sum
+            counts = _values[key] = [0] * (len(buckets) + 1) + [0.]
+        counts[i] += 1
+        counts[-1] += value
+        _state['dirty'] = True
+
+def inc(name, amount=1, **labels):
+    '''
+    Increase the counter name
+    '''
+    if not enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _values[key] = _values.get(key, 0) + amount
+        _state['dirty'] = True
+
+def timed(name):
+    '''
+    Decorator adding the run time of a function to the histogram name,
+    labelled with the function name
+    '''
+    def decorate(func):
+        if not enabled:
+            return func
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - start, function=func.__name__)
+        return wrapper
+    return decorate
+
+def flush():
+    '''
+    Write the counts of this process to its file if they changed
+    '''
+    if not enabled or not _state['dirty']:
+        return
+    with _lock:
+        values = [[name, labels, value] for (name, labels), value in _values.items()]
+        _state['dirty'] = False
+        if _state['file'] is None:
+            _state['file'] = os.path.join(directory, f'{os.getpid()}-{uuid.uuid4().hex[:8]}.json')
+        path = _state['file']
+    try:
+        os.makedirs(directory, exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(values, f)
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        _state['dirty'] = True
+        logger.warning(f'Could not write the metrics to {path}: {e}')
+
+def _collect():
+    '''
+    Sum of the counts of all the processes
+    '''
+    flush()
+    values = {}
+    try:
+        names = [n for n in os.listdir(directory) if n.endswith('.json')]
+    except FileNotFoundError:
+        names = []
+    for n in names:
+        try:
+            with open(os.path.join(directory, n)) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for name, labels, value in entries:
+            if name not in _metrics:
+                continue
+            key = (name, tuple(tuple(l) for l in labels))
+            held = values.get(key)
+            if held is None:
+                values[key] = value
+            elif isinstance(value, list):
+                if len(value) == len(held):
+                    values[key] = [a + b for a, b in zip(held, value)]
+            else:
+                values[key] = held + value
+    with _lock:
+        # this process when its file could not be read or written
+        if not names:
+            values = {k: list(v) if isinstance(v, list) else v for k, v in _values.items()}
+    return values
+
+def _labels(labels):
+    if not labels:
+        return ''
+    def escape(value):
+        return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in labels) + '}'
+
+def render():
+    '''
+    All the metrics in the Prometheus text format
+    '''
+    values = _collect()
+    lines = []
+    for name, (kind, text, buckets) in _metrics.items():
+        full = f'{namespace}_{name}'
+        lines += [f'# HELP {full} {text}', f'# TYPE {full} {kind}']
+        for (metric, labels), value in sorted(values.items()):
+            if metric != name:
+                continue
+            if kind == 'counter':
+                lines.append(f'{full}{_labels(labels)} {value}')
+                continue
+            total = 0
+            for le, count in zip([str(b) for b in buckets] + ['+Inf'], value[:-1]):
+                total += count
+                lines.append(f'{full}_bucket{_labels(labels + (("le", le),))} {total}')
+            lines.append(f'{full}_sum{_labels(labels)} {value[-1]}')
+            lines.append(f'{full}_count{_labels(labels)} {total}')
+    return '\n'.join(lines) + '\n'
+
+def install(server, path='/metrics'):
+    '''
+    Serve the metrics of the Flask server on path and record
+    the size of the callback responses
+    '''
+    @server.route(path)
+    def metrics():
+        return flask.Response(render(), mimetype='text/plain; version=0.0.4')
+
+    @server.after_request
+    def response_size(response):
+        if enabled and flask.request.path.endswith('/_dash-update-component'):
+            body = flask.request.get_json(silent=True) or {}
+            observe('response_bytes', response.calculate_content_length() or 0,
+                    output=body.get('output', ''))
+        flush()
+        return response
@@ -0,0 +1,159 @@
+'''
+Heavy callbacks run in a pool of worker processes, so pandas does not
+hold the GIL of the web server threads, and the requests of a session
+superseded by a newer one for the same callback are dropped before
+they run.
+
+Workers are spawned, they import the callback module once and attach
+to the shared store snapshot like any web worker. Coalescing is done
+by each web worker on the requests it receives. The metrics recorded
+by a worker are written to the shared metrics directory after each task.
+'''
+import functools, importlib, inspect, itertools, logging, multiprocessing, os, threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dash.exceptions import PreventUpdate
+from plotly.basedatatypes import BaseFigure
+import metrics
+
+logger = logging.getLogger('beachcleanbay_logger')
+
+# 0 runs the callbacks in the calling thread
+pool_size = int(os.getenv('CALLBACK_WORKERS', '2'))
+# background work (pre-rendering) has its own niced workers so it never
+# queues in front of the callbacks, by default one per core left by the
+# callback workers, 0 runs it in the calling thread
+background_size = int(os.getenv('BACKGROUND_WORKERS', max((os.cpu_count() or 1) - pool_size, 1)))
+background_nice = 10
+
+# True in the worker processes
+in_worker = False
+
+_pools = {}
+_pool_lock = threading.Lock()
+
+_tickets = itertools.count()
+_latest = {}    # (session, callback) -> ticket of the newest request
+_running = set()
+_cond = threading.Condition()
+
+def _get_pool(kind='callback'):
+    with _pool_lock:
+        pool = _pools.get(kind)
+        if pool is None:
+            size, initializer = (pool_size, _init_worker) if kind == 'callback' \
+                else (background_size, _init_background)
+            logger.info(f'Starting {size} {kind} workers')
+            pool = _pools[kind] = ProcessPoolExecutor(size, initializer=initializer,
+                mp_context=multiprocessing.get_context('spawn'))
+        return pool
+
+def _init_worker():
+    global in_worker
+    in_worker = True
+
+def _init_background():
+    _init_worker()
+    os.nice(background_nice)
+
+def _reset_pool(kind, pool):
+    '''
+    Drop a pool broken by a dead worker, the next call starts a new one
+    '''
+    with _pool_lock:
+        if _pools.get(kind) is pool:
+            logger.warning(f'A {kind} worker died, restarting the pool')
+            del _pools[kind]
+    pool.shutdown(wait=False)
+
+def _submit(func, *args):
+    pool = _get_pool()
+    try:
+        return pool.submit(func, *args).result()
+    except BrokenProcessPool:
+        _reset_pool('callback', pool)
+        raise
+
+def _plain(out):
+    # figures cross the process boundary as dicts, rebuilding
+    # a go.Figure on unpickling would validate it again
+    if isinstance(out, BaseFigure):
+        return out.to_plotly_json()
+    if isinstance(out, (tuple, list)):
+        return type(out)(_plain(o) for o in out)
+    return out
+
+def _run(module, name, args):
+    '''
+    Run the undecorated callback name of module (in a worker)
+    '''
+    func = inspect.unwrap(getattr(importlib.import_module(module), name))
+    try:
+        return _plain(func(*args))
+    finally:
+        metrics.flush()
+
+def _run_chunk(func, chunk):
+    try:
+        return func(chunk)
+    finally:
+        metrics.flush()
+
+def _wait_turn(key, ticket):
+    '''
+    Wait until no request of key runs, PreventUpdate if a newer one came
+    '''
+    with _cond:
+        while key in _running and _latest.get(key) == ticket:
+            _cond.wait()
+        if _latest.get(key) != ticket:
+            logger.debug(f'Dropping the superseded request of {key[1]}')
+            raise PreventUpdate
+        _running.add(key)
+
+def _done(key, ticket):
+    with _cond:
+        _running.discard(key)
+        if _latest.get(key) == ticket:
+            del _latest[key]
+        _cond.notify_all()
+
+def heavy(func):
+    '''
+    Decorator running a callback in the worker pool. Its session argument
+    (the session_id store) groups the requests: one request per session
+    runs at a time and only the newest waiting one runs after it.
+    '''
+    signature = inspect.signature(func)
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        session = signature.bind(*args, **kwargs).arguments.get('session')
+        key = (session, func.__name__)
+        if session is not None:
+            ticket = next(_tickets)
+            with _cond:
+                _latest[key] = ticket
+                _cond.notify_all()
+            _wait_turn(key, ticket)
+        try:
+            if pool_size:
+                return _submit(_run, func.__module__, func.__name__,
+                               signature.bind(*args, **kwargs).args)
+            return func(*args, **kwargs)
+        finally:
+            if session is not None:
+                _done(key, ticket)
+    return wrapper
+
+def run_background(func, chunks):
+    '''
+    Results of func on each chunk, computed by the background workers
+    '''
+    if not background_size:
+        return [func(chunk) for chunk in chunks]
+    pool = _get_pool('background')
+    try:
+        return list(pool.map(functools.partial(_run_chunk, func), chunks))
+    except BrokenProcessPool:
+        _reset_pool('background', pool)
+        raise
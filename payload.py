@@ -0,0 +1,109 @@
+'''
+Smaller figure payloads for slow connections. The figures are sent as
+dicts where numeric arrays are rounded to the precision shown on screen
+and the template only keeps the entries of the trace types and subplots
+the figure uses. dcc.Graph bundles plotly.js 2.25, which cannot decode
+typed (base64) arrays, so arrays stay JSON lists.
+'''
+import collections, functools, logging
+import numpy as np
+import plotly.io as pio
+
+import metrics
+
+logger = logging.getLogger('beachcleanbay_logger')
+
+coordinate_decimals = 5     # about 1 m
+value_decimals = 2          # the hover shows 2 decimals
+value_digits = 4            # small values (rates) keep 4 significant digits
+report_every = 10           # bytes saved are measured on one call out of report_every
+
+# subplots set by the template, and the trace types drawn on them
+_subplots = {
+    'polar': {'scatterpolar', 'scatterpolargl', 'barpolar'},
+    'ternary': {'scatterternary'},
+    'scene': {'scatter3d', 'surface', 'mesh3d', 'cone', 'streamtube', 'isosurface', 'volume'},
+    'geo': {'scattergeo', 'choropleth'},
+}
+_calls = collections.Counter()
+
+def quantize(values, decimals, digits=0):
+    '''
+    Float values rounded to decimals, values too small for that keep
+    digits significant digits. Other arrays are returned as they are.
+    '''
+    array = np.asarray(values)
+    if array.dtype.kind != 'f' or array.ndim != 1:
+        return values
+    places = np.full(len(array), float(decimals))
+    if digits:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            magnitude = np.floor(np.log10(np.abs(array)))
+        places = np.maximum(places, digits - 1 - np.where(np.isfinite(magnitude), magnitude, 0))
+    scale = 10. ** places
+    return np.round(array * scale) / scale
+
+def compact_trace(trace):
+    '''
+    Round the coordinates and values of a trace dict in place
+    '''
+    for key in ['lat', 'lon']:
+        if key in trace:
+            trace[key] = quantize(trace[key], coordinate_decimals)
+    for key in ['x', 'y']:
+        if key in trace:
+            trace[key] = quantize(trace[key], value_decimals, value_digits)
+    marker = trace.get('marker')
+    if isinstance(marker, dict):
+        for key in ['size', 'color']:
+            if key in marker:
+                marker[key] = quantize(marker[key], value_decimals, value_digits)
+    return trace
+
+def prune_template(figure):
+    '''
+    Drop the template entries of trace types and subplots
+    the figure does not use
+    '''
+    template = figure.get('layout', {}).get('template')
+    if not template:
+        return figure
+    types = {trace.get('type', 'scatter') for trace in figure.get('data', [])}
+    if 'data' in template:
+        template['data'] = {k: v for k, v in template['data'].items() if k in types}
+    layout = template.get('layout', {})
+    for subplot, subplot_types in _subplots.items():
+        if subplot in layout and not types & subplot_types and subplot not in figure['layout']:
+            del layout[subplot]
+    return figure
+
+def compact(figure):
+    '''
+    Figure (or trace) as a dict with rounded arrays and a pruned template
+    '''
+    if hasattr(figure, 'to_plotly_json'):
+        figure = figure.to_plotly_json()
+    if 'data' not in figure:
+        return compact_trace(figure)
+    for trace in figure['data']:
+        compact_trace(trace)
+    return prune_template(figure)
+
+def compact_figure(builder):
+    '''
+    Decorator compacting the figure returned by builder. The bytes saved
+    are added to the payload_saved_bytes histogram.
+    '''
+    @functools.wraps(builder)
+    def wrapper(*args, **kwargs):
+        figure = builder(*args, **kwargs)
+        calls = _calls[builder.__name__]
+        _calls[builder.__name__] += 1
+        if not (metrics.enabled and calls % report_every == 0):
+            return compact(figure)
+        before = len(pio.json.to_json_plotly(figure))
+        figure = compact(figure)
+        metrics.observe('payload_saved_bytes', before - len(pio.json.to_json_plotly(figure)),
+                        function=builder.__name__)
+        return figure
+    return wrapper
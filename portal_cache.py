@@ -0,0 +1,55 @@
+import logging, threading
+from collections import OrderedDict
+import orjson
+import plotly.io as pio
+
+import metrics
+
+logger = logging.getLogger('beachcleanbay_logger')
+
+# Serialized outputs of the portal callbacks for the most requested
+# filters, keyed by the normalized filters and the data version.
+# Entries are JSON bytes so a hit is never mutated by its reader,
+# the current data version replacing the cached one empties the cache.
+
+cache_size = 256
+
+_entries = OrderedDict()
+_version = [None]
+_lock = threading.Lock()
+
+def portal_key(year, sw_year, team, sw_team):
+    '''
+    Year and team of the selection, None when all of them are selected
+    '''
+    return (None if sw_year else year, None if sw_team else team)
+
+def get(version, key):
+    '''
+    Outputs cached for key in this data version, None if there are none
+    '''
+    with _lock:
+        data = _entries.get(key) if version == _version[0] else None
+        if data is not None:
+            _entries.move_to_end(key)
+    metrics.inc('cache_requests_total', cache='portal', result='miss' if data is None else 'hit')
+    return None if data is None else orjson.loads(data)
+
+def put(version, key, outputs, current):
+    '''
+    Cache the outputs (figures and values) of key for this data version.
+    Outputs of a version other than current, the data version served now,
+    are dropped so a late request never empties the cache of the new one.
+    '''
+    if not cache_size or version != current:
+        return
+    data = pio.json.to_json_plotly(outputs).encode()
+    with _lock:
+        if version != _version[0]:
+            logger.debug('New data version, emptying the portal cache')
+            _entries.clear()
+            _version[0] = version
+        _entries[key] = data
+        _entries.move_to_end(key)
+        while len(_entries) > cache_size:
+            _entries.popitem(last=False)
@@ -0,0 +1,115 @@
+import logging
+from datetime import date
+import numpy as np
+import pandas as pd
+from sqlalchemy import Date, cast, func, select
+
+from db import Beach, WeightData
+from store import earth_radius_km
+
+logger = logging.getLogger('beachcleanbay_logger')
+
+# Aggregations pushed down to the database, only result-sized data
+# crosses the wire. The frames have the same columns as the store ones.
+
+def _filter(query, year, team, all_years, all_teams, beach=None):
+    if not all_years:
+        query = query.where(WeightData.Dates >= date(year, 1, 1),
+                            WeightData.Dates < date(year + 1, 1, 1))
+    if not all_teams:
+        query = query.where(WeightData.Teams.any(team))
+    if beach is not None:
+        query = query.where(WeightData.Beach == beach)
+    return query
+
+def beach_stats(cnx, year=None, team=None, all_years=True, all_teams=True):
+    '''
+    Weight, Count, First and Last date for each (Beach, Lat, Longit)
+    '''
+    logger.debug('Querying the beach statistics')
+    keys = [WeightData.Beach, WeightData.Lat, WeightData.Longit]
+    query = select(*keys,
+                   func.sum(WeightData.Weight).label('Weight'),
+                   func.count(WeightData.Weight).label('Count'),
+                   func.min(WeightData.Dates).label('First'),
+                   func.max(WeightData.Dates).label('Last')).group_by(*keys).order_by(*keys)
+    grouped = pd.read_sql(_filter(query, year, team, all_years, all_teams), cnx)
+    for col in ['First', 'Last']:
+        grouped[col] = pd.to_datetime(grouped[col])
+    return grouped
+
+def beach_count(cnx):
+    '''
+    Number of (Beach, Lat, Longit) of beach_stats
+    '''
+    keys = select(WeightData.Beach, WeightData.Lat, WeightData.Longit).distinct().subquery()
+    return cnx.execute(select(func.count()).select_from(keys)).scalar()
+
+def monthly_weight(cnx, year=None, team=None, all_years=True, all_teams=True, beach=None):
+    '''
+    Weight collected each month (Dates is the first day of the month)
+    '''
+    logger.debug('Querying the monthly weight')
+    month = cast(func.date_trunc('month', WeightData.Dates), Date)
+    query = select(month.label('Dates'),
+                   func.sum(WeightData.Weight).label('Weight')).group_by(month).order_by(month)
+    monthly = pd.read_sql(_filter(query, year, team, all_years, all_teams, beach), cnx)
+    monthly['Dates'] = pd.to_datetime(monthly['Dates'])
+    return monthly
+
+def daily_weight(cnx, beach, coordinates=False):
+    '''
+    Weight collected on a beach for each date,
+    and each coordinates if asked
+    '''
+    logger.debug(f'Querying the daily weight of {beach}')
+    keys = [WeightData.Dates] + ([WeightData.Lat, WeightData.Longit] if coordinates else [])
+    query = select(*keys, func.sum(WeightData.Weight).label('Weight')) \
+        .where(WeightData.Beach == beach).group_by(*keys).order_by(*keys)
+    daily = pd.read_sql(query, cnx)
+    daily['Dates'] = pd.to_datetime(daily['Dates'])
+    return daily
+
+def team_names(cnx):
+    '''
+    Distinct teams found in the Teams arrays
+    '''
+    team = func.unnest(WeightData.Teams)
+    names = pd.read_sql(select(team.label('Team')).distinct().order_by('Team'), cnx)
+    return names['Team'].values
+
+def beaches_near(cnx, lat, lon, radius_km):
+    '''
+    Beach sites in the box holding the radius_km circle around (lat, lon)
+    '''
+    dlat = np.degrees(radius_km / earth_radius_km)
+    dlon = dlat / np.cos(np.radians(abs(lat) + dlat)) if abs(lat) + dlat < 90 else 180.
+    query = select(Beach.Beach, Beach.Lat, Beach.Lon).where(
+        Beach.Lat.between(lat - dlat, lat + dlat), Beach.Lon.between(lon - dlon, lon + dlon))
+    return pd.read_sql(query, cnx)
+
+def search_beaches(cnx, text, k, country=None, state=None):
+    '''
+    Registry beaches whose name holds text, the ones starting with it first
+    '''
+    text = ' '.join((text or '').split())
+    pattern = text.replace('\\', '\\\\').replace('%', r'\%').replace('_', r'\_')
+    query = select(Beach.Beach, Beach.Country, Beach.State).distinct() \
+        .where(Beach.Beach.ilike(f'%{pattern}%'))
+    if country:
+        query = query.where(Beach.Country == country)
+    if state:
+        query = query.where(Beach.State == state)
+    prefix = Beach.Beach.ilike(f'{pattern}%')
+    query = query.add_columns(prefix.label('Prefix')).order_by(prefix.desc(), Beach.Beach).limit(k)
+    return pd.read_sql(query, cnx).drop(columns='Prefix')
+
+def beach_facets(cnx, country=None):
+    '''
+    Countries of the registry, or the states of country
+    '''
+    column = Beach.State if country else Beach.Country
+    query = select(column).distinct().where(column.is_not(None)).order_by(column)
+    if country:
+        query = query.where(Beach.Country == country)
+    return pd.read_sql(query, cnx).iloc[:, 0].tolist()
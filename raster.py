@@ -0,0 +1,120 @@
+import base64, logging, struct, threading, zlib
+from collections import OrderedDict
+import numpy as np
+from colorcet import fire
+
+import metrics
+from store import mercator
+
+logger = logging.getLogger('beachcleanbay_logger')
+
+# The density maps are drawn as 256 px Web Mercator tiles, each tile
+# aggregates the beaches in raster_px x raster_px cells on the server
+# and is sent as a PNG image layer, so the figure size does not depend
+# on the number of beaches.
+
+raster_px = 64
+raster_max_zoom = 16
+raster_max_tiles = 64
+tile_cache_size = 2048
+
+_palette = np.array([[int(c[i:i+2], 16) for i in (1, 3, 5)] for c in fire], dtype=np.uint8)
+_tiles = OrderedDict()
+_tiles_lock = threading.Lock()
+
+def png(rgba):
+    '''
+    PNG file of an RGBA image (height x width x 4 uint8)
+    '''
+    height, width = rgba.shape[:2]
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data \
+            + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    rows = np.hstack([np.zeros((height, 1), dtype=np.uint8), rgba.reshape(height, -1)])
+    return b'\x89PNG\r\n\x1a\n' \
+        + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)) \
+        + chunk(b'IDAT', zlib.compress(rows.tobytes(), 6)) \
+        + chunk(b'IEND', b'')
+
+def tile_corners(z, x, y):
+    '''
+    [lon, lat] of the top left, top right, bottom right
+    and bottom left corners of a tile
+    '''
+    def lon(x):
+        return x / 2**z * 360 - 180
+    def lat(y):
+        return float(np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * y / 2**z)))))
+    return [[lon(x), lat(y)], [lon(x + 1), lat(y)], [lon(x + 1), lat(y + 1)], [lon(x), lat(y + 1)]]
+
+def shade(values, vmax):
+    '''
+    Colour the cells on a log scale, empty cells are transparent
+    '''
+    level = np.log1p(np.clip(values, 0, None)) / np.log1p(max(vmax, 1e-9))
+    rgba = np.zeros(values.shape + (4,), dtype=np.uint8)
+    rgba[..., :3] = _palette[np.clip(level * (len(_palette) - 1), 0, len(_palette) - 1).astype(int)]
+    rgba[..., 3] = np.where(values > 0, 210, 0)
+    return rgba
+
+def render_tile(px, py, values, vmax, z, x, y):
+    '''
+    Image layer of a tile from the pixel positions (px, py) at zoom z
+    of the points and their values, None when the tile is empty
+    '''
+    inside = (px >= x * 256) & (px < (x + 1) * 256) & (py >= y * 256) & (py < (y + 1) * 256)
+    if not inside.any():
+        return None
+    cells, _, _ = np.histogram2d(py[inside] - y * 256, px[inside] - x * 256,
+                                 bins=raster_px, range=[[0, 256], [0, 256]], weights=values[inside])
+    source = base64.b64encode(png(shade(cells, vmax))).decode()
+    return dict(sourcetype='image', source=f'data:image/png;base64,{source}',
+                coordinates=tile_corners(z, x, y), below='traces')
+
+def view_tiles(zoom, bounds):
+    '''
+    (z, x, y) of the tiles covering bounds (lon_min, lat_min, lon_max, lat_max)
+    '''
+    z = int(np.clip(np.floor(zoom), 0, raster_max_zoom))
+    lon_min, lat_min, lon_max, lat_max = bounds
+    x, y = mercator([lat_max, lat_min], [lon_min, lon_max])
+    x = np.clip((x * 2**z / 256).astype(int), 0, 2**z - 1)
+    y = np.clip((y * 2**z / 256).astype(int), 0, 2**z - 1)
+    tiles = [(z, i, j) for i in range(x[0], x[1] + 1) for j in range(y[0], y[1] + 1)]
+    return tiles[:raster_max_tiles]
+
+def raster_layers(grouped, col, zoom, bounds, key):
+    '''
+    Image layers of the density of col in grouped for the tiles seen
+    at this zoom. Tiles are cached by (key, zoom, tile), key must change
+    with the data and the filters. Without bounds the tiles cover all beaches.
+    '''
+    grouped = grouped[grouped[col] > 0]
+    if not len(grouped):
+        return []
+    if bounds is None:
+        bounds = (grouped['Longit'].min(), grouped['Lat'].min(),
+                  grouped['Longit'].max(), grouped['Lat'].max())
+    tiles = view_tiles(zoom, bounds)
+    layers = {}
+    with _tiles_lock:
+        for t in tiles:
+            if (key,) + t in _tiles:
+                _tiles.move_to_end((key,) + t)
+                layers[t] = _tiles[(key,) + t]
+    missing = [t for t in tiles if t not in layers]
+    metrics.inc('cache_requests_total', len(layers), cache='tiles', result='hit')
+    metrics.inc('cache_requests_total', len(missing), cache='tiles', result='miss')
+    if missing:
+        logger.debug(f'Rendering {len(missing)} tiles')
+        z = tiles[0][0]
+        px, py = mercator(grouped['Lat'], grouped['Longit'])
+        values = grouped[col].values.astype(float)
+        for t in missing:
+            layers[t] = render_tile(px * 2**z, py * 2**z, values, values.max(), *t)
+        with _tiles_lock:
+            for t in missing:
+                _tiles[(key,) + t] = layers[t]
+            while len(_tiles) > tile_cache_size:
+                _tiles.popitem(last=False)
+    return [layers[t] for t in tiles if layers[t] is not None]
@@ -0,0 +1,760 @@
+import contextlib, fcntl, json, logging, os, pickle, shutil, time, uuid
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger('beachcleanbay_logger')
+
+####### STORE ###############
+
+grouped_keys = ['Beach', 'Lat', 'Longit']
+
+def prepare_records(df):
+    '''
+    Type the columns of freshly loaded weight records in a compact layout:
+    dictionary encoded strings, float32 coordinates and int32 Id.
+    '''
+    df['Id'] = df['Id'].astype('int32')
+    df['Weight'] = df['Weight'].astype('float')
+    df['Dates'] = pd.to_datetime(df['Dates'])
+    for col in ['Lat', 'Longit']:
+        df[col] = df[col].astype('float32')
+    for col in ['Beach', 'team', 'person']:
+        df[col] = df[col].astype('category')
+    return df
+
+def concat_records(*frames):
+    '''
+    Append records, merging the categories of the encoded columns
+    '''
+    merged = pd.concat(frames, ignore_index=True)
+    for col in merged.columns:
+        if isinstance(frames[0][col].dtype, pd.CategoricalDtype) and not isinstance(merged[col].dtype, pd.CategoricalDtype):
+            merged[col] = pd.api.types.union_categoricals([f[col] for f in frames], sort_categories=True)
+    return merged
+
+def bytes_per_row(df):
+    return df.memory_usage(deep=True).sum() / max(len(df), 1)
+
+def high_water_mark(df, beaches, previous=None):
+    '''
+    Highest Id loaded from each table
+    '''
+    hwm = dict(previous or {'WeightData': -1, 'Beach2coord': -1})
+    if len(df):
+        hwm['WeightData'] = max(hwm['WeightData'], int(df['Id'].max()))
+    if len(beaches):
+        hwm['Beach2coord'] = max(hwm['Beach2coord'], int(beaches['Id'].max()))
+    return hwm
+
+def build_store(df, beaches):
+    '''
+    Build the store from a full load of the records (df) and
+    beach properties (beaches): cumulative weight for each beach (grouped),
+    the aggregate cubes used by the portal map, the pollution rates,
+    the monthly rollups of the trend curves, the position of each beach in the sorted records,
+    the distinct teams of the Teams arrays,
+    the grid index of the beach sites and the beach name search index.
+    '''
+    df = df.reset_index(drop=True)
+    rows, names = team_pairs(df)
+    df, beach_index, order = partition_by_beach(df.drop(columns='Teams'))
+    rows = np.argsort(order)[rows]
+    grouped = df.groupby(grouped_keys, observed=True)['Weight'].sum().reset_index()
+    cube, team_cube = build_cube(df, rows, names)
+    daily, daily_index = build_daily(df)
+    logger.info(f'Store holds {len(df)} records, {bytes_per_row(df):.1f} bytes per record')
+    return {'df': df, 'grouped': grouped, 'beaches': beaches, **build_rollups(df, rows, names),
+            'cube': cube, 'team_cube': team_cube, 'beach_index': beach_index,
+            'rates': beach_rates(cube_select({'cube': cube}, None, None)),
+            'daily': daily, 'daily_index': daily_index,
+            'teams': distinct_teams(names),
+            **build_site_index(beaches), **build_search_index(beaches, beach_index),
+            'hwm': high_water_mark(df, beaches),
+            'loaded': time.time(),
+            'refreshed': time.time(),
+            'version': uuid.uuid4().hex}
+
+def merge_store(previous, new, new_beaches):
+    '''
+    Merge the records added since the previous store was built.
+    Only the new records are aggregated, then combined with the previous
+    aggregates. The records and daily weights are only sorted again for
+    the beaches of the new records, then spliced into the previous ones.
+    The time of the last full load is kept.
+    '''
+    logger.info(f'Merging {len(new)} new records')
+    new = new.reset_index(drop=True)
+    new_rows, new_names = team_pairs(new)
+    new = new.drop(columns='Teams')
+    cube, team_cube = build_cube(new, new_rows, new_names)
+    grouped = pd.concat([previous['grouped'],
+                         new.groupby(grouped_keys, observed=True)['Weight'].sum().reset_index()]) \
+                .groupby(grouped_keys, observed=True)['Weight'].sum().reset_index()
+    held = [previous['beach_index'][b] for b in new['Beach'].unique() if b in previous['beach_index']]
+    rows = np.concatenate([np.arange(lo, hi) for lo, hi in held]) if held else np.array([], dtype=np.int64)
+    part, part_index, _ = partition_by_beach(concat_records(previous['df'].take(rows), new))
+    df, beach_index = splice_slices(previous['df'], previous['beach_index'], part, part_index)
+    daily, daily_index = splice_slices(previous['daily'], previous['daily_index'], *build_daily(part))
+    logger.info(f'Store holds {len(df)} records, {bytes_per_row(df):.1f} bytes per record')
+    beaches = pd.concat([previous['beaches'], new_beaches], ignore_index=True)
+    sites = build_site_index(beaches) if len(new_beaches) else {k: previous[k] for k in site_keys}
+    cube = merge_cube(previous['cube'], cube)
+    return dict(previous, df=df, grouped=grouped, beaches=beaches, **sites,
+                **merge_search_index(previous, beaches, new_beaches, beach_index),
+                **merge_rollups(previous, build_rollups(new, new_rows, new_names)),
+                cube=cube, rates=beach_rates(cube_select({'cube': cube}, None, None)),
+                daily=daily, daily_index=daily_index,
+                team_cube=merge_cube(previous['team_cube'], team_cube),
+                beach_index=beach_index,
+                teams=distinct_teams(np.concatenate([previous['teams'], new_names])),
+                hwm=high_water_mark(new, new_beaches, previous['hwm']),
+                refreshed=time.time(),
+                version=uuid.uuid4().hex)
+
+####### AGGREGATE CUBE ###############
+
+cube_keys = ['Year', 'Beach', 'Lat', 'Longit']
+cube_aggs = dict(Weight=('Weight', 'sum'),
+                 Count=('Weight', 'count'),
+                 First=('Dates', 'min'),
+                 Last=('Dates', 'max'))
+
+def build_cube(df, rows, names):
+    '''
+    Pre-aggregate the weight data by year and beach (cube)
+    and by team, year and beach (team_cube), from the (rows, names)
+    record/team pairs. A record shared by several teams counts once
+    in each of them.
+    '''
+    logger.debug('Building the aggregate cube')
+    base = df[['Beach', 'Lat', 'Longit', 'Weight', 'Dates']].assign(Year=df.Dates.dt.year)
+    cube = base.groupby(cube_keys, observed=True).agg(**cube_aggs).sort_index()
+    exploded = base.take(rows).assign(Team=names)
+    team_cube = exploded.groupby(['Team'] + cube_keys, observed=True).agg(**cube_aggs).sort_index()
+    return cube, team_cube
+
+def merge_cube(cube, delta):
+    '''
+    Combine two cubes sharing the same keys
+    '''
+    return pd.concat([cube, delta]).groupby(level=cube.index.names, observed=True).agg(
+        {'Weight': 'sum', 'Count': 'sum', 'First': 'min', 'Last': 'max'})
+
+def cube_select(store, year, team, all_years=True, all_teams=True):
+    '''
+    Reduce the cube to one row per beach (Beach, Lat, Longit)
+    with the Weight, Count, First and Last date of the selection.
+    '''
+    cube = store['cube']
+    try:
+        if not all_teams:
+            cube = store['team_cube'].xs(team, level='Team')
+        if not all_years:
+            return cube.xs(year, level='Year').reset_index()
+    except KeyError:
+        return pd.DataFrame(columns=cube_keys[1:] + list(cube_aggs))
+    return cube.groupby(level=cube_keys[1:], observed=True).agg(
+        {'Weight': 'sum', 'Count': 'sum', 'First': 'min', 'Last': 'max'}).reset_index()
+
+
+####### RATES ###############
+
+min_rate_days = 7
+
+def beach_rates(grouped):
+    '''
+    Beaches of grouped cleaned over more than min_rate_days
+    with their pollution rate (kg/day) from the first to the last clean
+    '''
+    days = ((grouped['Last'] - grouped['First']) / pd.Timedelta('1 day')).values
+    keep = days > min_rate_days
+    return grouped[keep].assign(Rates=grouped['Weight'].values[keep] / days[keep]) \
+        .reset_index(drop=True)
+
+def build_daily(df):
+    '''
+    Weight collected on each beach and date, in one pass over records
+    sorted by beach and date: the cumulative weight of the beach,
+    the pollution rate since its previous clean (kg/day, NaN for the first)
+    and the middle of that interval. daily_index is the slice of each beach.
+    '''
+    beach = pd.factorize(df['Beach'])[0]
+    dates = df['Dates'].values
+    new = np.ones(len(df), dtype=bool)
+    new[1:] = (beach[1:] != beach[:-1]) | (dates[1:] != dates[:-1])
+    starts = np.flatnonzero(new)
+    weight = np.add.reduceat(df['Weight'].values, starts) if len(starts) else np.array([])
+    beach, dates = beach[starts], dates[starts]
+    first = np.ones(len(starts), dtype=bool)
+    first[1:] = beach[1:] != beach[:-1]
+    previous = np.roll(dates, 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rate = np.where(first, np.nan, weight / ((dates - previous) / np.timedelta64(1, 'D')))
+    lo = np.flatnonzero(first)
+    cum = pd.Series(weight).groupby(np.cumsum(first)).cumsum().values
+    daily = pd.DataFrame({'Beach': df['Beach'].values[starts], 'Dates': dates, 'Weight': weight,
+                          'Cum_weight': cum, 'Rate': rate,
+                          'Mid': np.where(first, np.datetime64('NaT'), previous + (dates - previous) / 2)})
+    hi = np.append(lo[1:], len(daily))
+    return daily, dict(zip(daily['Beach'].values[lo], zip(lo, hi)))
+
+def daily_records(store, beach):
+    '''
+    Daily weight and rates of one beach, sorted by date
+    '''
+    lo, hi = store['daily_index'].get(beach, (0, 0))
+    return store['daily'].iloc[lo:hi]
+
+
+####### ROLLUPS ###############
+# Monthly weight of each beach, of each team and of all the records
+# for the trend curves, Dates is the first day of the month.
+
+def build_rollups(df, rows, names):
+    '''
+    Monthly rollups of the records, a record shared by several
+    teams counts once in each of them
+    '''
+    base = pd.DataFrame({'Beach': df['Beach'].values,
+                         'Dates': df['Dates'].values.astype('M8[M]').astype('M8[ns]'),
+                         'Weight': df['Weight'].values})
+    monthly = base.groupby(['Beach', 'Dates'], observed=True)[['Weight']].sum().sort_index()
+    team_monthly = base.take(rows).assign(Team=names) \
+        .groupby(['Team', 'Dates'])[['Weight']].sum().sort_index()
+    return {'monthly': monthly, 'team_monthly': team_monthly,
+            'monthly_total': monthly.groupby(level='Dates').sum()}
+
+def merge_rollups(previous, delta):
+    '''
+    Add the rollups of new records to the previous ones
+    '''
+    return {key: pd.concat([previous[key], rollup]).groupby(
+                level=rollup.index.names, observed=True).sum().sort_index()
+            for key, rollup in delta.items()}
+
+def monthly_select(store, year, team, all_years=True, all_teams=True, beach=None):
+    '''
+    Monthly weight (Dates, Weight) of a beach, a team or all the records,
+    for one year or all of them
+    '''
+    try:
+        if beach is not None:
+            monthly = store['monthly'].xs(beach, level='Beach')
+        elif not all_teams:
+            monthly = store['team_monthly'].xs(team, level='Team')
+        else:
+            monthly = store['monthly_total']
+    except KeyError:
+        return pd.DataFrame({'Dates': pd.to_datetime([]), 'Weight': []})
+    if not all_years:
+        monthly = monthly[monthly.index.year == year]
+    return monthly.reset_index()
+
+
+####### BEACH SEARCH ###############
+# Beach names of the registry and of the records sorted by their search
+# key for prefix lookups, with the trigrams of the keys for fuzzy ones:
+# the rows of search_grams[i] are search_rows[search_ptr[i]:search_ptr[i+1]].
+
+search_limit = 20
+min_similarity = 0.3
+
+def search_key(names):
+    '''
+    Lower case names without accents and repeated spaces
+    '''
+    return names.astype(str).str.normalize('NFKD').str.encode('ascii', 'ignore') \
+        .str.decode('ascii').str.lower().str.split().str.join(' ')
+
+def trigrams(key):
+    '''
+    Trigrams of each word of key, padded like pg_trgm
+    '''
+    return {f'  {word} '[i:i+3] for word in key.split() for i in range(len(word) + 1)}
+
+def build_search_index(beaches, beach_index):
+    '''
+    Search index of the beaches with their Country, State and
+    number of records
+    '''
+    records = pd.Series({b: hi - lo for b, (lo, hi) in beach_index.items()}, dtype='int64')
+    registry = beaches.dropna(subset=['Beach']).drop_duplicates('Beach').set_index('Beach')
+    names = registry.index.astype(str).union(records.index.astype(str))
+    search = pd.DataFrame({'Beach': names.values.astype(object),
+                           'Country': registry['Country'].reindex(names).values,
+                           'State': registry['State'].reindex(names).values,
+                           'Records': records.reindex(names).fillna(0).astype('int64').values})
+    search['Key'] = search_key(search['Beach']).values
+    # names only spelled differently in the records take the registry facets
+    search[['Country', 'State']] = search.groupby('Key')[['Country', 'State']].transform('first')
+    search = search.sort_values('Key', ignore_index=True)
+    pairs = [(gram, row) for row, key in enumerate(search['Key']) for gram in trigrams(key)]
+    grams, rows = zip(*pairs) if pairs else ((), ())
+    codes, search_grams = pd.factorize(pd.Series(grams, dtype=object), sort=True)
+    order = np.argsort(codes, kind='stable')
+    return {'search': search,
+            'search_grams': np.asarray(search_grams, dtype=object),
+            'search_rows': np.asarray(rows, dtype=np.int32)[order],
+            'search_ptr': np.searchsorted(codes[order], np.arange(len(search_grams) + 1))}
+
+def merge_search_index(previous, beaches, new_beaches, beach_index):
+    '''
+    Search index after a merge: only the numbers of records change,
+    unless the registry or the records bring new names
+    '''
+    search = previous['search']
+    if len(new_beaches) or not set(beach_index) <= set(search['Beach']):
+        return build_search_index(beaches, beach_index)
+    records = pd.Series({b: hi - lo for b, (lo, hi) in beach_index.items()}, dtype='int64')
+    return {'search': search.assign(Records=records.reindex(search['Beach']).fillna(0).astype('int64').values),
+            **{k: previous[k] for k in ['search_grams', 'search_rows', 'search_ptr']}}
+
+def search_beaches(store, text, k=search_limit, country=None, state=None):
+    '''
+    Beaches (Beach, Country, State) matching text, best first: names
+    starting with it, then names sharing most of its trigrams (typos,
+    words in another order), the most recorded first.
+    Country and state restrict the matches.
+    '''
+    search = store['search']
+    keep = np.ones(len(search), dtype=bool)
+    if country:
+        keep &= (search['Country'] == country).values
+    if state:
+        keep &= (search['State'] == state).values
+    key = search_key(pd.Series([text or ''])).iloc[0]
+    score = np.zeros(len(search))
+    if key:
+        grams = sorted(trigrams(key))
+        index, ptr = store['search_grams'], store['search_ptr']
+        found = [i for i, g in zip(np.searchsorted(index, grams), grams) if i < len(index) and index[i] == g]
+        rows = [store['search_rows'][ptr[i]:ptr[i+1]] for i in found]
+        score = np.bincount(np.concatenate(rows), minlength=len(search)) / len(grams) \
+            if rows else np.zeros(len(search))
+        lo, hi = np.searchsorted(search['Key'].values, [key, key + '\uffff'])
+        score[lo:hi] += 2
+        keep &= score >= min_similarity
+    order = np.lexsort((np.arange(len(search)), -search['Records'].values, -score))
+    return search.iloc[order[keep[order]][:k]][['Beach', 'Country', 'State']]
+
+
+####### BEACH PARTITION ###############
+
+def partition_by_beach(df):
+    '''
+    Sort the records by beach and date and index the position
+    of each beach slice, so a beach lookup only touches its own records.
+    The previous position of each record is returned as order.
+    '''
+    logger.debug('Partitioning the records by beach')
+    df = df.sort_values(['Beach', 'Dates'], kind='mergesort')
+    order = df.index.values
+    df = df.reset_index(drop=True)
+    bounds = pd.Series(np.arange(len(df))).groupby(df['Beach'].values, observed=True).agg(['min', 'max'])
+    beach_index = {beach: (lo, hi + 1) for beach, lo, hi in
+                   zip(bounds.index, bounds['min'], bounds['max'])}
+    return df, beach_index, order
+
+def splice_slices(frame, index, part, part_index):
+    '''
+    frame (sorted by beach, with the slices of index) where the beaches
+    of part replace their slice or are inserted in beach order.
+    Rows outside the slices (no beach) stay at the end.
+    Returns the spliced frame and its index.
+    '''
+    keys = sorted(k for k in set(index) | set(part_index) if isinstance(k, str))
+    ranges = np.array([np.add(part_index[k], len(frame)) if k in part_index else index[k]
+                       for k in keys], dtype=np.int64).reshape(-1, 2)
+    lo, size = ranges[:, 0], ranges[:, 1] - ranges[:, 0]
+    start = np.cumsum(size) - size
+    tail = max((hi for k, (lo_, hi) in index.items() if isinstance(k, str)), default=0)
+    part_tail = max((hi for k, (lo_, hi) in part_index.items() if isinstance(k, str)), default=0)
+    rows = np.concatenate([np.repeat(lo - start, size) + np.arange(size.sum()),
+                           np.arange(tail, len(frame)),
+                           np.arange(len(frame) + part_tail, len(frame) + len(part))])
+    spliced = concat_records(frame, part).take(rows).reset_index(drop=True)
+    return spliced, dict(zip(keys, zip(start, start + size)))
+
+def beach_records(store, beach):
+    '''
+    Records of one beach, sorted by date
+    '''
+    lo, hi = store['beach_index'].get(beach, (0, 0))
+    return store['df'].iloc[lo:hi]
+
+
+####### TEAMS ###############
+
+def team_pairs(df):
+    '''
+    Unpack the Teams arrays into (rows, names): the position of a record
+    and one of its teams, once per distinct team of the record.
+    '''
+    teams = df['Teams'].explode().dropna()
+    pairs = pd.DataFrame({'Row': teams.index.values, 'Team': teams.values}).drop_duplicates()
+    return pairs['Row'].values.astype(np.int64), pairs['Team'].values.astype(object)
+
+def distinct_teams(names):
+    '''
+    Sorted distinct teams of the (rows, names) pairs
+    '''
+    return np.unique(np.asarray(names).astype(str)).astype(object)
+
+
+####### SITE INDEX ###############
+# Beach sites bucketed in a grid of site_cell_deg degrees, a radius query
+# only measures the sites of the cells overlapping the circle.
+
+site_cell_deg = 0.1
+earth_radius_km = 6371.0088
+_lon_cells = int(np.ceil(360 / site_cell_deg))
+
+def haversine(lat1, lon1, lat2, lon2):
+    '''
+    Great circle distance in km
+    '''
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+    return 2 * earth_radius_km * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def _site_cell(lat, lon):
+    i = np.floor((np.asarray(lat) + 90) / site_cell_deg).astype(np.int64)
+    j = np.floor((np.asarray(lon) + 180) / site_cell_deg).astype(np.int64) % _lon_cells
+    return i * _lon_cells + j
+
+site_keys = ['site_cells', 'site_ptr', 'site_rows', 'site_lat', 'site_lon']
+
+def build_site_index(beaches):
+    '''
+    Sort the beach sites by grid cell: the sites of site_cells[i] are
+    site_rows[site_ptr[i]:site_ptr[i+1]] (positions in beaches),
+    site_lat and site_lon follow site_rows.
+    '''
+    lat = beaches['Lat'].values.astype(float)
+    lon = beaches['Lon'].values.astype(float)
+    rows = np.flatnonzero(np.isfinite(lat) & np.isfinite(lon))
+    cells = _site_cell(lat[rows], lon[rows])
+    order = np.argsort(cells, kind='stable')
+    site_cells, site_ptr = np.unique(cells[order], return_index=True)
+    rows = rows[order]
+    return {'site_cells': site_cells, 'site_ptr': np.append(site_ptr, len(rows)),
+            'site_rows': rows, 'site_lat': lat[rows], 'site_lon': lon[rows]}
+
+def sites_within(store, lat, lon, radius_km):
+    '''
+    Positions in store['beaches'] of the sites within radius_km
+    of (lat, lon) and their distance, nearest first
+    '''
+    dlat = np.degrees(radius_km / earth_radius_km)
+    # a circle around a pole covers every longitude
+    dlon = dlat / np.cos(np.radians(abs(lat) + dlat)) if abs(lat) + dlat < 90 else 180.
+    i0, i1 = np.floor((np.array([lat - dlat, lat + dlat]) + 90) / site_cell_deg).astype(np.int64)
+    j0, j1 = np.floor((np.array([lon - dlon, lon + dlon]) + 180) / site_cell_deg).astype(np.int64)
+    i = np.arange(max(i0, 0), min(i1, int(180 / site_cell_deg) - 1) + 1)
+    j = np.arange(j0, min(j1, j0 + _lon_cells - 1) + 1) % _lon_cells
+    keys = (i[:, None] * _lon_cells + j[None, :]).ravel()
+    cells, ptr = store['site_cells'], store['site_ptr']
+    found = np.searchsorted(cells, keys)
+    hit = found < len(cells)
+    hit[hit] = cells[found[hit]] == keys[hit]
+    if not hit.any():
+        return np.array([], dtype=np.int64), np.array([])
+    starts, sizes = ptr[found[hit]], np.diff(ptr)[found[hit]]
+    pos = np.repeat(starts - np.cumsum(sizes) + sizes, sizes) + np.arange(sizes.sum())
+    dist = haversine(lat, lon, store['site_lat'][pos], store['site_lon'][pos])
+    near = np.flatnonzero(dist <= radius_km)
+    near = near[np.argsort(dist[near], kind='stable')]
+    return store['site_rows'][pos[near]], dist[near]
+
+def nearest_sites(store, lat, lon, k=5, max_km=50.):
+    '''
+    Positions and distances of the k sites nearest to (lat, lon),
+    looking no further than max_km
+    '''
+    radius = site_cell_deg * 111.2 / 4
+    while True:
+        rows, dist = sites_within(store, lat, lon, min(radius, max_km))
+        if len(rows) >= k or radius >= max_km:
+            return rows[:k], dist[:k]
+        radius *= 3
+
+
+####### MAP CLUSTERS ###############
+# Beaches close to each other on the screen are merged into one point,
+# so the maps send a bounded number of points whatever the number of beaches.
+
+cluster_px = 40
+cluster_max_zoom = 12
+cluster_max_points = 1000
+
+def mercator(lat, lon):
+    '''
+    Web Mercator position at zoom 0 (the world is 256 px wide)
+    '''
+    lat = np.radians(np.clip(np.asarray(lat, dtype=float), -85.05, 85.05))
+    x = (np.asarray(lon, dtype=float) + 180) / 360 * 256
+    y = (1 - np.arcsinh(np.tan(lat)) / np.pi) / 2 * 256
+    return x, y
+
+def view_bounds(lat, lon, zoom, width=2000, height=1000):
+    '''
+    (lon_min, lat_min, lon_max, lat_max) seen around a center
+    on a screen of width x height pixels
+    '''
+    x, y = mercator(lat, lon)
+    dx, dy = width / 2 / 2.**zoom, height / 2 / 2.**zoom
+    lons = (x + np.array([-dx, dx])) / 256 * 360 - 180
+    lats = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + np.array([dy, -dy])) / 256))))
+    return lons[0], lats[0], lons[1], lats[1]
+
+def map_view(stream, zoom=4):
+    '''
+    Zoom and bounds of a map from its relayoutData,
+    no bounds when it does not give them
+    '''
+    try:
+        corners = np.array(stream['mapbox._derived']['coordinates'], dtype=float)
+        return stream['mapbox.zoom'], (corners[:, 0].min(), corners[:, 1].min(),
+                                       corners[:, 0].max(), corners[:, 1].max())
+    except (KeyError, TypeError, IndexError):
+        return zoom, None
+
+def cluster_beaches(grouped, zoom, bounds=None, margin=0.1):
+    '''
+    Beaches of grouped inside bounds (widened by margin), merged by cells
+    of cluster_px pixels at this zoom. Weight, Count and Rates are summed,
+    the position is the mean of the beaches and Beaches counts them.
+    Beaches stay apart when there are few of them or the zoom is close,
+    and when there are few of them all are kept whatever the bounds.
+    '''
+    if len(grouped) <= cluster_max_points:
+        return grouped.assign(Beaches=1).reset_index(drop=True)
+    if bounds is not None:
+        lon_min, lat_min, lon_max, lat_max = bounds
+        dlon, dlat = margin * (lon_max - lon_min), margin * (lat_max - lat_min)
+        inside = grouped['Longit'].between(lon_min - dlon, lon_max + dlon) \
+                 & grouped['Lat'].between(lat_min - dlat, lat_max + dlat)
+        grouped = grouped[inside.values]
+    grouped = grouped.assign(Beaches=1)
+    if zoom >= cluster_max_zoom or len(grouped) <= cluster_max_points:
+        return grouped.reset_index(drop=True)
+
+    logger.debug(f'Clustering {len(grouped)} beaches at zoom {zoom:.1f}')
+    x, y = mercator(grouped['Lat'], grouped['Longit'])
+    size = cluster_px / 2.**zoom
+    cell = np.floor(x / size).astype(np.int64) << 32 | np.floor(y / size).astype(np.int64)
+    aggs = dict(Beach=('Beach', 'first'), Lat=('Lat', 'mean'), Longit=('Longit', 'mean'),
+                Beaches=('Beaches', 'sum'))
+    aggs.update({c: (c, 'sum') for c in ['Weight', 'Count', 'Rates'] if c in grouped})
+    aggs.update({c: (c, f) for c, f in [('First', 'min'), ('Last', 'max')] if c in grouped})
+    clusters = grouped.groupby(cell).agg(**aggs).reset_index(drop=True)
+    clusters['Beach'] = clusters['Beach'].astype(object).where(
+        clusters['Beaches'] == 1, clusters['Beaches'].astype(str) + ' beaches')
+    return clusters
+
+
+####### SHARED SNAPSHOT ###############
+# The store is published as memory-mapped column blocks so every worker
+# attaches to the same pages instead of holding its own copy.
+# Numeric and date columns are stacked per dtype into one 2D block,
+# categorical columns map their codes, other string columns are dictionary
+# encoded and decoded on attach, plain arrays are mapped as they are
+# and anything else is pickled. Indexes map their codes or values.
+
+def _save_frame(frame, path, name):
+    '''
+    Write the columns of a dataframe as .npy blocks, return its manifest entry
+    '''
+    index = None
+    if not isinstance(frame.index, pd.RangeIndex) or frame.index.start != 0:
+        index = _save_index(frame.index, path, name)
+    entry = {'index': index, 'blocks': []}
+    by_dtype, objects = {}, []
+    for col in frame.columns:
+        values = frame[col].values
+        if isinstance(frame[col].dtype, pd.CategoricalDtype):
+            file = f'{name}.{len(entry["blocks"])}.npy'
+            np.save(os.path.join(path, file), frame[col].cat.codes.values)
+            entry['blocks'].append({'kind': 'category', 'file': file, 'columns': [col],
+                                    'categories': frame[col].cat.categories.tolist()})
+        elif values.dtype.kind in 'biufM':
+            by_dtype.setdefault(values.dtype.str, []).append(col)
+        elif pd.api.types.infer_dtype(values, skipna=True) == 'string':
+            codes, categories = pd.factorize(values)
+            file = f'{name}.{len(entry["blocks"])}.npy'
+            np.save(os.path.join(path, file), codes.astype(np.min_scalar_type(-len(categories)-1)))
+            entry['blocks'].append({'kind': 'strings', 'file': file, 'columns': [col],
+                                    'categories': categories.tolist()})
+        else:
+            objects.append(col)
+    for dtype, cols in by_dtype.items():
+        block = np.stack([frame[c].values for c in cols])
+        kind = 'numeric'
+        if block.dtype.kind == 'M':
+            block, kind = block.view('i8'), 'dates'
+        file = f'{name}.{len(entry["blocks"])}.npy'
+        np.save(os.path.join(path, file), block)
+        entry['blocks'].append({'kind': kind, 'file': file, 'columns': cols})
+    if objects:
+        file = f'{name}.objects.pkl'
+        frame[objects].to_pickle(os.path.join(path, file))
+        entry['blocks'].append({'kind': 'objects', 'file': file, 'columns': objects})
+    return entry
+
+def _save_index(index, path, name):
+    '''
+    Write an index so it attaches without copying: the codes of each
+    level of a MultiIndex (its small levels are pickled) or the values
+    of a numeric index
+    '''
+    if isinstance(index, pd.MultiIndex):
+        codes = []
+        for i, level_codes in enumerate(index.codes):
+            codes.append(f'{name}.codes{i}.npy')
+            np.save(os.path.join(path, codes[-1]), np.asarray(level_codes))
+        pd.to_pickle(list(index.levels), os.path.join(path, f'{name}.levels.pkl'))
+        return {'names': list(index.names), 'codes': codes, 'levels': f'{name}.levels.pkl'}
+    if index.dtype.kind in 'biufM':
+        np.save(os.path.join(path, f'{name}.index.npy'), index.values)
+        return {'names': [index.name], 'values': f'{name}.index.npy'}
+    pd.to_pickle(index, os.path.join(path, f'{name}.index.pkl'))
+    return {'names': [index.name], 'pickle': f'{name}.index.pkl'}
+
+def _load_index(entry, path):
+    if 'codes' in entry:
+        return pd.MultiIndex(levels=pd.read_pickle(os.path.join(path, entry['levels'])),
+                             codes=[np.load(os.path.join(path, f), mmap_mode='r') for f in entry['codes']],
+                             names=entry['names'], verify_integrity=False)
+    if 'values' in entry:
+        return pd.Index(np.load(os.path.join(path, entry['values']), mmap_mode='r'),
+                        name=entry['names'][0], copy=False)
+    return pd.read_pickle(os.path.join(path, entry['pickle']))
+
+def _load_frame(entry, path):
+    '''
+    Attach the blocks of a dataframe without copying the numeric columns
+    '''
+    parts = []
+    for block in entry['blocks']:
+        file = os.path.join(path, block['file'])
+        if block['kind'] == 'objects':
+            parts.append(pd.read_pickle(file))
+            continue
+        values = np.load(file, mmap_mode='r')
+        if block['kind'] == 'category':
+            parts.append(pd.DataFrame({block['columns'][0]:
+                pd.Categorical.from_codes(values, categories=block['categories'])}, copy=False))
+        elif block['kind'] == 'strings':
+            # code -1 (missing) picks the trailing None
+            categories = np.array(block['categories'] + [None], dtype=object)
+            parts.append(pd.DataFrame({block['columns'][0]: categories[values]}))
+        else:
+            if block['kind'] == 'dates':
+                values = values.view('M8[ns]')
+            parts.append(pd.DataFrame(values.T, columns=block['columns'], copy=False))
+    frame = pd.concat(parts, axis=1, copy=False) if parts else pd.DataFrame()
+    if isinstance(entry['index'], list):
+        # snapshots published before the index was mapped
+        return frame.set_index(entry['index'])
+    if entry['index']:
+        # set_index would copy the columns
+        index = _load_index(entry['index'], path)
+        if not parts:
+            return pd.DataFrame(index=index)
+        frame.index = index
+    return frame
+
+@contextlib.contextmanager
+def store_lock(root):
+    '''
+    Exclusive lock of the workers loading and publishing under root
+    '''
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, 'lock'), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def publish_store(store, root, keep=2):
+    '''
+    Write the store under root/<version> and point root/current to it.
+    Both steps are atomic renames, so readers see either version whole.
+    A version already written is not written again, only its refreshed
+    time in root/current is updated.
+    Only the last `keep` versions are kept; workers still mapping
+    a removed version keep their pages until they let it go.
+    Publishers are expected to hold store_lock.
+    '''
+    version = store['version']
+    path = os.path.join(root, version)
+    if not os.path.exists(path):
+        tmp = path + '.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        manifest = {'frames': {}, 'arrays': {}}
+        others = {}
+        for key, value in store.items():
+            if isinstance(value, pd.DataFrame):
+                manifest['frames'][key] = _save_frame(value, tmp, key)
+            elif isinstance(value, np.ndarray) and value.dtype != object:
+                manifest['arrays'][key] = f'{key}.npy'
+                np.save(os.path.join(tmp, f'{key}.npy'), value)
+            else:
+                others[key] = value
+        with open(os.path.join(tmp, 'objects.pkl'), 'wb') as f:
+            pickle.dump(others, f)
+        with open(os.path.join(tmp, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+        os.rename(tmp, path)
+    pointer = os.path.join(root, f'current.{version}.{os.getpid()}.tmp')
+    with open(pointer, 'w') as f:
+        f.write(f'{version} {store["refreshed"]}')
+    os.replace(pointer, os.path.join(root, 'current'))
+    published = sorted((os.path.join(root, d) for d in os.listdir(root) if not d.endswith('.tmp')
+                        and d != version and os.path.isdir(os.path.join(root, d))), key=os.path.getmtime)
+    for old in published[:len(published)-keep+1]:
+        shutil.rmtree(old, ignore_errors=True)
+    logger.info(f'Published store {version}')
+    return version
+
+def current_version(root):
+    '''
+    Version of the published store and the time it was last
+    refreshed from the database, (None, 0.) if there is none
+    '''
+    try:
+        with open(os.path.join(root, 'current')) as f:
+            version, _, refreshed = f.read().strip().partition(' ')
+    except FileNotFoundError:
+        return None, 0.
+    return version or None, float(refreshed or 0.)
+
+def drop_current(root):
+    '''
+    Unpublish the current store so the next refresh rebuilds it
+    '''
+    try:
+        os.remove(os.path.join(root, 'current'))
+    except FileNotFoundError:
+        pass
+
+def attach_store(root, version):
+    '''
+    Map a published store, None if that version is gone
+    '''
+    path = os.path.join(root, version)
+    try:
+        with open(os.path.join(path, 'manifest.json')) as f:
+            manifest = json.load(f)
+        with open(os.path.join(path, 'objects.pkl'), 'rb') as f:
+            store = pickle.load(f)
+        for key, entry in manifest['frames'].items():
+            store[key] = _load_frame(entry, path)
+        for key, file in manifest['arrays'].items():
+            store[key] = np.load(os.path.join(path, file), mmap_mode='r')
+    except FileNotFoundError:
+        logger.debug(f'Store {version} is no longer published')
+        return None
+    return store